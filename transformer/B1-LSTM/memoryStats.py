@@ -0,0 +1,118 @@
+"""Process and tensor memory statistics for the training log."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import gc
+import ctypes
+import ctypes.util
+import resource
+
+import torch
+
+class _Mallinfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in
+                ['arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks',
+                 'fsmblks', 'uordblks', 'fordblks', 'keepcost']]
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    except OSError:
+        return None
+
+# CPU tensors are allocated by c10's CPU allocator, which does not cache
+# and has no statistics of its own; it gets its memory from the C library
+_libc = _load_libc()
+
+def _proc_status_mb(field):
+    """Reads a kB field (e.g. VmHWM) of /proc/self/status in MB."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    return None
+
+def reset_peak():
+    """Starts a new measurement window for the peak statistics."""
+    # Writing 5 to clear_refs resets VmHWM (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+def peak_rss():
+    """Peak resident set size (MB) since reset_peak().
+
+    Falls back to the peak over the process lifetime where the kernel
+    cannot reset it.
+    """
+    peak = _proc_status_mb('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return peak
+
+def cpu_allocator():
+    """
+    Heap statistics (MB) of the C allocator behind CPU tensors: bytes in
+    use, bytes freed but still held by the process, and bytes in chunks
+    mapped on their own. Empty without glibc's mallinfo2 (glibc >= 2.33);
+    with jemalloc or tcmalloc preloaded, these describe glibc's unused heap.
+    """
+    if _libc is None or not hasattr(_libc, 'mallinfo2'):
+        return {}
+    _libc.mallinfo2.restype = _Mallinfo2
+    info = _libc.mallinfo2()
+    return {'heap_in_use': info.uordblks / 1024.0 ** 2,
+            'heap_free': info.fordblks / 1024.0 ** 2,
+            'heap_mmapped': info.hblkhd / 1024.0 ** 2}
+
+def trim():
+    """Returns freed heap pages to the OS (glibc malloc_trim), so that the
+    RSS after a large epoch does not mask the peak of the next one."""
+    if _libc is not None and hasattr(_libc, 'malloc_trim'):
+        _libc.malloc_trim(0)
+
+def live_tensors():
+    """Number and total size (MB) of tensors tracked by the collector."""
+    count, size = 0, 0
+    for obj in gc.get_objects():
+        try:
+            if torch.is_tensor(obj):
+                count += 1
+                size += obj.element_size() * obj.nelement()
+        except Exception:
+            continue
+    return count, size / 1024.0 ** 2
+
+def summary(count_tensors=False):
+    """Dictionary of memory statistics (sizes in MB)."""
+    stats = {'peak_rss': peak_rss(), 'rss': _proc_status_mb('VmRSS')}
+    stats.update(cpu_allocator())
+    if torch.cuda.is_available():
+        stats['allocated'] = torch.cuda.memory_allocated() / 1024.0 ** 2
+        stats['peak_allocated'] = torch.cuda.max_memory_allocated() / 1024.0 ** 2
+        stats['reserved'] = torch.cuda.memory_reserved() / 1024.0 ** 2
+    if count_tensors:
+        # Scanning every object is slow, so this is opt-in
+        stats['live_tensors'], stats['live_tensor_mb'] = live_tensors()
+    return stats
+
+def format_summary(stats):
+    fields = []
+    for k, v in stats.items():
+        if v is None:
+            continue
+        if isinstance(v, int):
+            fields.append('{}: {}'.format(k, v))
+        else:
+            fields.append('{}: {:.1f}'.format(k, v))
+    return '\t'.join(fields)
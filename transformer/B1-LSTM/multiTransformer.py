@@ -2,7 +2,9 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import math, copy, time
+from collections import namedtuple
 from torch.autograd import Variable
 import matplotlib.pyplot as plt
 
@@ -33,6 +35,61 @@ def attention(query, key, value, mask=None, dropout=None):
         p_attn = dropout(p_attn)
     return torch.matmul(p_attn, value), p_attn
 
+def fused_attention(query, key, value, mask=None, dropout_p=0.0):
+    '''
+    Same as attention() through F.scaled_dot_product_attention, without
+    materializing the attention weights
+    '''
+    if mask is None:
+        return F.scaled_dot_product_attention(query, key, value, dropout_p=dropout_p)
+    keep = mask != 0
+    # attention() gives rows with every key masked uniform weights, i.e.
+    # the mean of value; let SDPA see all keys there and patch them after
+    empty = ~keep.any(dim=-1, keepdim=True)
+    x = F.scaled_dot_product_attention(query, key, value, attn_mask=keep | empty,
+                                       dropout_p=dropout_p)
+    return torch.where(empty, value.mean(dim=-2, keepdim=True), x)
+
+def local_attention(query, key, value, window, n_global=0, mask=None, dropout=None):
+    '''
+    attention() restricted to keys at most window steps away, plus
+    n_global leading timesteps that attend to and are attended by every
+    timestep. mask, if given, masks keys (batch x 1 x 1 x T). Time and
+    memory are O(T*(window + n_global)) instead of O(T^2)
+    '''
+    nbatches, h, T, d_k = query.size()
+    width = 2*window + 1
+    # batch x h x T x d_k x width views of the keys/values around each step
+    def band(x):
+        return F.pad(x, (0, 0, window, window)).unfold(2, width, 1)
+    # Key position of every band slot, masked outside the sequence and
+    # on global keys (those are scored separately below)
+    pos = torch.arange(T, device=query.device).unsqueeze(1) \
+          + torch.arange(-window, window + 1, device=query.device)
+    allowed = (pos >= n_global) & (pos < T)
+    if mask is not None:
+        keep = mask.reshape(nbatches, 1, T).float()
+        allowed = allowed & (F.pad(keep, (window, window)).unfold(2, width, 1) != 0)
+    scores = torch.einsum('bhtd,bhtdw->bhtw', query, band(key)) / math.sqrt(d_k)
+    scores = scores.masked_fill(~allowed, -1e9)
+    if n_global > 0:
+        global_scores = torch.matmul(query, key[:, :, :n_global].transpose(-2, -1)) \
+                        / math.sqrt(d_k)
+        if mask is not None:
+            global_scores = global_scores.masked_fill(keep[:, :, :n_global].unsqueeze(1) == 0, -1e9)
+        scores = torch.cat([global_scores, scores], dim=-1)
+    p_attn = F.softmax(scores, dim=-1)
+    if dropout is not None:
+        p_attn = dropout(p_attn)
+    x = torch.einsum('bhtw,bhtdw->bhtd', p_attn[..., n_global:], band(value))
+    if n_global > 0:
+        x = x + torch.matmul(p_attn[..., :n_global], value[:, :, :n_global])
+        # Global timesteps attend to the whole sequence
+        x_global, _ = attention(query[:, :, :n_global], key, value, mask=mask,
+                                dropout=dropout)
+        x = torch.cat([x_global, x[:, :, n_global:]], dim=2)
+    return x
+
 # class MFN(nn.Module):
 #     def __init__(self, mods, dims, total_embed_size, output_dim,
 #                  device=torch.device('cuda:0')):
@@ -90,17 +147,29 @@ def attention(query, key, value, mask=None, dropout=None):
 #         pass
 
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, h, d_model, dropout=0.1):
+    def __init__(self, h, d_model, dropout=0.1, store_attn=False,
+                 window=None, n_global=0):
         super(MultiHeadedAttention, self).__init__()
         assert d_model % h == 0
         # We assume d_v always equals d_k
         self.d_k = d_model // h
         self.h = h
         self.linears = clones(nn.Linear(d_model, d_model), 4)
+        # Keep the attention weights of the last forward in self.attn
+        # (needs the unfused path)
+        self.store_attn = store_attn
         self.attn = None
+        # Attend within window steps (plus n_global global steps) if set
+        self.window = window
+        self.n_global = n_global
         self.dropout = nn.Dropout(p=dropout)
-        
-    def forward(self, query, key, value, mask=None):
+        # Optional (h,) scale of each head's output, whose gradient tells
+        # how much the head matters (see prune.py)
+        self.head_gate = None
+
+    def forward(self, query, key, value, mask=None, lengths=None):
+        if lengths is not None:
+            return self._forward_packed(query, key, value, lengths)
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)
@@ -111,25 +180,148 @@ class MultiHeadedAttention(nn.Module):
             [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2)
              for l, x in zip(self.linears, (query, key, value))]
         
-        # 2) Apply attention on all the projected vectors in batch. 
-        x, self.attn = attention(query, key, value, mask=mask, 
-                                 dropout=self.dropout)
-        
-        # 3) "Concat" using a view and apply a final linear. 
+        # 2) Apply attention on all the projected vectors in batch.
+        if self.window is not None:
+            x = local_attention(query, key, value, self.window, self.n_global,
+                                mask=mask, dropout=self.dropout)
+        elif self.store_attn or not hasattr(F, 'scaled_dot_product_attention'):
+            x, self.attn = attention(query, key, value, mask=mask,
+                                     dropout=self.dropout)
+        else:
+            x = fused_attention(query, key, value, mask=mask,
+                                dropout_p=self.dropout.p if self.training else 0.0)
+
+        if self.head_gate is not None:
+            x = x * self.head_gate.view(1, -1, 1, 1)
+
+        # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous() \
              .view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)
 
+    def _forward_packed(self, query, key, value, lengths):
+        """Self-attention within each sequence of packed (sum(lengths),
+        d_model) inputs, whose rows hold one sequence after another."""
+        # h x sum(lengths) x d_k projections
+        query, key, value = \
+            [l(x).view(-1, self.h, self.d_k).transpose(0, 1)
+             for l, x in zip(self.linears, (query, key, value))]
+        x = []
+        for q, k, v in zip(query.split(lengths, 1), key.split(lengths, 1),
+                           value.split(lengths, 1)):
+            if self.window is not None:
+                x.append(local_attention(q.unsqueeze(0), k.unsqueeze(0), v.unsqueeze(0),
+                                         self.window, self.n_global,
+                                         dropout=self.dropout).squeeze(0))
+            elif hasattr(F, 'scaled_dot_product_attention'):
+                x.append(F.scaled_dot_product_attention(
+                    q, k, v, dropout_p=self.dropout.p if self.training else 0.0))
+            else:
+                x.append(attention(q, k, v, dropout=self.dropout)[0])
+        x = torch.cat(x, dim=1)
+        if self.head_gate is not None:
+            x = x * self.head_gate.view(-1, 1, 1)
+        x = x.transpose(0, 1).contiguous() \
+             .view(-1, self.h * self.d_k)
+        return self.linears[-1](x)
+
+    def prune_heads(self, heads):
+        """Keeps only the given heads, shrinking the projections to them."""
+        index = torch.cat([torch.arange(i*self.d_k, (i+1)*self.d_k) for i in sorted(heads)])
+        index = index.to(self.linears[0].weight.device)
+        for l in self.linears[:3]:
+            _prune_linear(l, index, 0)
+        _prune_linear(self.linears[-1], index, 1)
+        self.h = len(heads)
+        self.attn = None
+
 class Encoder(nn.Module):
-    def __init__(self, layer, N):
+    def __init__(self, layer, N, varlen=False, checkpoint=0):
         super(Encoder, self).__init__()
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.size)
-        
+        # Skip padded timesteps altogether, see set_varlen()
+        self.varlen = varlen
+        # Layers per checkpointed segment (0 stores all), see set_checkpoint()
+        self.checkpoint = checkpoint
+
     def forward(self, x, mask):
-        for layer in self.layers:
-            x = layer(x, mask)
-        return self.norm(x)
+        # mask is batch x seq_len x 1 and marks the real timesteps
+        if self.varlen:
+            return self._forward_packed(x, mask)
+        # Mask padded keys: batch x 1 x seq_len
+        mask = mask.transpose(-2, -1)
+        return self.norm(self._run_layers(x, mask))
+
+    def _forward_packed(self, x, mask):
+        """Runs the layers on the real timesteps only, packed one sequence
+        after another; padded outputs are zero."""
+        real = mask.squeeze(-1) != 0
+        lengths = real.sum(dim=1).tolist()
+        packed = self.norm(self._run_layers(x[real], None, lengths))
+        output = packed.new_zeros(x.size())
+        output[real] = packed
+        return output
+
+    def _run_layers(self, x, mask, lengths=None):
+        """Applies the layers. While training with checkpointing on, only
+        the input of each segment of self.checkpoint layers is kept for
+        backward and the segment is recomputed from it."""
+        if self.checkpoint > 0 and self.training and torch.is_grad_enabled():
+            for start in range(0, len(self.layers), self.checkpoint):
+                x = torch.utils.checkpoint.checkpoint(
+                    self._run_segment, x, mask, lengths, start, self.checkpoint,
+                    use_reentrant=False)
+            return x
+        return self._run_segment(x, mask, lengths, 0, len(self.layers))
+
+    def _run_segment(self, x, mask, lengths, start, size):
+        for layer in self.layers[start:start+size]:
+            x = layer(x, mask, lengths)
+        return x
+
+    def prune_layers(self, layers):
+        """Keeps only the given layers, in order."""
+        self.layers = nn.ModuleList([self.layers[i] for i in sorted(layers)])
+
+def set_varlen(model, varlen=True):
+    """Switches every Encoder in model to variable-length execution."""
+    for module in model.modules():
+        if isinstance(module, Encoder):
+            module.varlen = varlen
+
+def set_checkpoint(model, layers=1):
+    """Checkpoints every Encoder in model in segments of layers encoder
+    layers while training, trading a second forward pass of each segment
+    for its stored activations; 0 switches checkpointing off."""
+    for module in model.modules():
+        if isinstance(module, Encoder):
+            module.checkpoint = layers
+
+def encoder_structure(model):
+    """Heads of every layer of every Encoder in model, by module name."""
+    return {name: [layer.self_attn.h for layer in module.layers]
+            for name, module in model.named_modules() if isinstance(module, Encoder)}
+
+def apply_structure(model, structure):
+    """Shrinks the Encoders of a freshly constructed model to a structure
+    from encoder_structure() of a pruned one, whose state dict then loads."""
+    for name, heads in structure.items():
+        encoder = model.get_submodule(name)
+        encoder.prune_layers(range(len(heads)))
+        for layer, h in zip(encoder.layers, heads):
+            if h < layer.self_attn.h:
+                layer.self_attn.prune_heads(range(h))
+
+def _prune_linear(linear, index, dim):
+    """Keeps the output (dim 0) or input (dim 1) features of linear at index."""
+    linear.weight = nn.Parameter(linear.weight.detach().index_select(dim, index).clone())
+    if dim == 0:
+        if linear.bias is not None:
+            linear.bias = nn.Parameter(linear.bias.detach().index_select(0, index).clone())
+        linear.out_features = len(index)
+    else:
+        linear.in_features = len(index)
 
 def clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
@@ -167,17 +359,76 @@ class EncoderLayer(nn.Module):
         self.sublayer = clones(SublayerConnection(size, dropout), 2)
         self.size = size
 
-    def forward(self, x, mask):
-        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))
+    def forward(self, x, mask, lengths=None):
+        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask, lengths))
         return self.sublayer[1](x, self.feed_forward)
 
+# Decoder state of UniTransformer and NLPTransformer: the previous LSTM
+# output and the (n_layers, n, embed_dim) LSTM hidden and cell states
+DecoderState = namedtuple('DecoderState', ['o_prev', 'h', 'c'])
+
+def _autocast_enabled():
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+def _float_weights(*modules):
+    """Whether modules are still float layers, whose weights the compiled
+    paths read directly (dynamic quantization replaces them)."""
+    return all(type(m) in (nn.Linear, nn.LSTM, nn.LSTMCell) for m in modules)
+
+@torch.jit.script
+def _decoder_recurrence(gxs: torch.Tensor, o_prev: torch.Tensor,
+                        h: torch.Tensor, c: torch.Tensor, w_o: torch.Tensor,
+                        w_hh: torch.Tensor, b_hh: torch.Tensor):
+    """
+    Single-layer LSTM decoder fed its own previous output, compiled so the
+    loop runs without the interpreter. gxs holds the t x n x 4*hidden input
+    gates of the encoder outputs and w_o the input weights of the previous
+    output. After the first step the previous output is h, so w_o and w_hh
+    are folded into one recurrent weight. Returns the t x n x hidden outputs
+    and the final h and c.
+    """
+    t = gxs.size(0)
+    outputs = h.new_empty([t, h.size(0), h.size(1)])
+    w_fold = w_o + w_hh
+    for i in range(t):
+        if i == 0:
+            gates = gxs[i] + F.linear(o_prev, w_o) + F.linear(h, w_hh, b_hh)
+        else:
+            gates = gxs[i] + F.linear(h, w_fold, b_hh)
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+        c = torch.sigmoid(forgetgate)*c + torch.sigmoid(ingate)*torch.tanh(cellgate)
+        h = torch.sigmoid(outgate)*torch.tanh(c)
+        outputs[i] = h
+    return outputs, h, c
+
+def fused_decode(decoder, out, encoded, state):
+    """
+    Decodes n x t x embed_dim encoder outputs from state with the
+    single-layer LSTM decoder and out MLP of UniTransformer/NLPTransformer.
+    Projects the encoder half of the decoder inputs and applies out for all
+    timesteps at once, and runs the recurrence compiled. Returns the
+    n x t x 1 predictions and the final state, like a loop over step().
+    """
+    embed_dim = decoder.hidden_size
+    w_ih = decoder.weight_ih_l0
+    # Decoder inputs are [o_prev, encoded_t]
+    gxs = F.linear(encoded, w_ih[:, embed_dim:], decoder.bias_ih_l0).transpose(0, 1)
+    outputs, h, c = _decoder_recurrence(gxs, state.o_prev, state.h[0], state.c[0],
+                                        w_ih[:, :embed_dim], decoder.weight_hh_l0,
+                                        decoder.bias_hh_l0)
+    outputs = outputs.transpose(0, 1) # n, t, embed_dim
+    return out(outputs), DecoderState(outputs[:, -1], h.unsqueeze(0), c.unsqueeze(0))
+
 class NLPTransformer(nn.Module):
     def __init__(self, window_embed_size, embed_dim=256, h_dim=128, 
                  N=6, d_ff=128, h=8, dropout=0.1, n_layers=1,
+                 window=None, n_global=0, fused=True,
                  device=torch.device('cuda:0')):
         super(NLPTransformer, self).__init__()
         self.embed_dim = embed_dim
         self.h_dim = h_dim
+        # Decode with fused_decode, see decode()
+        self.fused = fused
         # embedding layers
         # Create raw-to-embed FC+Dropout layer
         self.embed = nn.Sequential(nn.Dropout(0.1),
@@ -189,7 +440,7 @@ class NLPTransformer(nn.Module):
         # encoder = encoder layer + sublayer connection
         # encoder layer = attention layer + feedforward + norm layer
         c = copy.deepcopy
-        attn = MultiHeadedAttention(h, embed_dim)
+        attn = MultiHeadedAttention(h, embed_dim, window=window, n_global=n_global)
         ff = PositionwiseFeedForward(embed_dim, d_ff, dropout)
         self.encoder = Encoder(EncoderLayer(embed_dim, c(attn), c(ff), dropout), N)
         # Decodes targets and LSTM hidden states
@@ -206,31 +457,53 @@ class NLPTransformer(nn.Module):
                        torch.device('cpu'))
         self.to(self.device)
 
+    def init_state(self, batch_size):
+        """Initial decoder state for batch_size sequences."""
+        return DecoderState(torch.zeros(batch_size, self.embed_dim).to(self.device),
+                            self.dec_h0.repeat(1, batch_size, 1),
+                            self.dec_c0.repeat(1, batch_size, 1))
+
+    def encode(self, inputs, mask):
+        """Encoder outputs (batch_size, seq_len, embed_dim) of whole sequences,
+        since self-attention looks at every window of a sequence."""
+        return self.encoder(self.embed(inputs), mask)
+
+    def step(self, encoded_t, state):
+        """
+        Decodes one timestep of n x embed_dim encoder output, returns the
+        n x 1 prediction and the new state; the module itself holds no
+        state, so one model can serve many sequences.
+        """
+        # Concatenate prediction from previous timestep to context
+        i = torch.cat([state.o_prev, encoded_t], dim=1).unsqueeze(1)
+        # Get next decoder LSTM state and output
+        o, (h, c) = self.decoder(i, (state.h, state.c))
+        # Computer prediction from output state
+        p = self.out(o.view(-1, self.embed_dim))
+        return p, DecoderState(o.squeeze(1), h, c)
+
+    def decode(self, encoded, state):
+        """
+        Decodes n x t x embed_dim encoder outputs from state, returns the
+        n x t x 1 predictions and the final state. Uses fused_decode unless
+        fused is off, the decoder is stacked or quantized, or autocast is
+        active.
+        """
+        if self.fused and self.decoder.num_layers == 1 and not _autocast_enabled() \
+           and _float_weights(self.decoder):
+            return fused_decode(self.decoder, self.out, encoded, state)
+        predicted = []
+        for t in range(encoded.size(1)):
+            p, state = self.step(encoded[:,t,:], state)
+            predicted.append(p.unsqueeze(1))
+        return torch.cat(predicted, dim=1), state
+
     def forward(self, inputs, mask, lengths, tgt_init=0.5, target=None):
         # Get batch dim
         batch_size, seq_len = len(lengths), max(lengths)
-        # Convert raw features into equal-dimensional embeddings
-        embed = self.embed(inputs)
-        encoder_output = self.encoder(embed, mask) # batch_size, seq_len, self.embed_dim
+        encoder_output = self.encode(inputs, mask) # batch_size, seq_len, self.embed_dim
         # LSTM output from the encoder
-        # Set initial hidden and cell states for decoder
-        h0 = self.dec_h0.repeat(1, batch_size, 1)
-        c0 = self.dec_c0.repeat(1, batch_size, 1)
-        predicted = []
-        # p = torch.ones(batch_size, 1).to(self.device) * tgt_init
-        o_prev = torch.zeros(batch_size, self.embed_dim).to(self.device)
-        h, c = h0, c0
-        for t in range(seq_len):
-            # Concatenate prediction from previous timestep to context
-            i = torch.cat([o_prev, encoder_output[:,t,:]], dim=1).unsqueeze(1)
-            # Get next decoder LSTM state and output
-            o, (h, c) = self.decoder(i, (h, c))
-            o_prev = o.squeeze(1)
-            # Computer prediction from output state
-            p = self.out(o.view(-1, self.embed_dim))
-            predicted.append(p.unsqueeze(1))
-            # print(predicted)
-        predicted = torch.cat(predicted, dim=1)
+        predicted, _ = self.decode(encoder_output, self.init_state(batch_size))
         # Mask target entries that exceed sequence lengths
         predicted = predicted * mask.float()
         return predicted
@@ -4,10 +4,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
-import sys, os, shutil
+import sys, os, shutil, time
 import argparse
 import copy
 import csv
+import functools
 import pandas as pd
 import numpy as np
 from scipy.stats import pearsonr
@@ -22,6 +23,10 @@ from torch.utils.data import DataLoader
 from datasets import seq_collate_dict, load_dataset
 from models import MultiLSTM, MultiEDLSTM, MultiARLSTM, MultiCNNLSTM
 from multiTransformer import NLPTransformer
+from asyncEval import AsyncEvaluator
+import ddp
+import memoryStats
+from metricsSink import MetricsSink
 
 from random import shuffle
 from operator import itemgetter
@@ -29,14 +34,23 @@ import pprint
 
 import logging
 logFilename = "./train_cnn.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(message)s",
-    handlers=[
-        logging.FileHandler(logFilename, 'w'),
-        logging.StreamHandler()
-    ])
 logger = logging.getLogger()
+# Per-batch and per-epoch scalars, opened by setup_logging()
+metrics = MetricsSink()
+
+def setup_logging(mode='w'):
+    """Logs to logFilename and the console, and metrics next to it (kept
+    out of import time so that spawned worker processes do not truncate
+    the log)."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(message)s",
+        handlers=[
+            logging.FileHandler(logFilename, mode),
+            logging.StreamHandler()
+        ])
+    base = os.path.splitext(logFilename)[0]
+    metrics.open(base + '_metrics.jsonl', base + '_arrays', mode)
 
 def eval_ccc(y_true, y_pred):
     """Computes concordance correlation coefficient."""
@@ -70,12 +84,16 @@ def generateInputChunkHelper(data_chunk, length_chunk):
 '''
 yielding training batch for the training process
 '''
-def generateTrainBatch(input_data, input_target, input_length, args, batch_size=25):
+def generateTrainBatch(input_data, input_target, input_length, args, batch_size=25, indices=None):
     # TODO: support input_data as a dictionary
     # get chunk
     input_size = len(input_data[list(input_data.keys())[0]]) # all values have same size
-    index = [i for i in range(0, input_size)]
-    # shuffle(index)
+    if indices is not None:
+        # only this process' share of the sequences (distributed training)
+        index = list(indices)
+    else:
+        index = [i for i in range(0, input_size)]
+        # shuffle(index)
     shuffle_chunks = [i for i in chunks(index, batch_size)]
     for chunk in shuffle_chunks:
         # chunk yielding data
@@ -104,7 +122,7 @@ def generateTrainBatch(input_data, input_target, input_length, args, batch_size=
         # yielding for each batch
         yield (yield_input_data, torch.unsqueeze(target_sort, dim=2), lstm_masks, length_chunk)
 
-def train(input_data, input_target, lengths, model, criterion, optimizer, epoch, args):
+def train(input_data, input_target, lengths, model, criterion, optimizer, epoch, args, sampler=None):
     # TODO: support input_data as a dictionary
     # input_data = input_data['linguistic']
 
@@ -112,11 +130,19 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
     data_num = 0
     loss = 0.0
     batch_num = 0
+    memoryStats.reset_peak()
+    # Print the running loss args.log_freq times per epoch
+    batch_size = 25
+    num_seqs = len(sampler) if sampler is not None else len(lengths)
+    log_every = max(1, int(np.ceil(num_seqs / batch_size / args.log_freq)))
+    start = time.time()
     # batch our data
     for (data, target, mask, lengths) in generateTrainBatch(input_data,
                                                             input_target,
                                                             lengths,
-                                                            args):
+                                                            args,
+                                                            batch_size=batch_size,
+                                                            indices=sampler):
 
         # send to device
         mask = mask.to(args.device)
@@ -126,12 +152,16 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
         # lengths = lengths.to(args.device)
-        # Run forward pass.
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         # Compute loss and gradients
         batch_loss = criterion(output, target)
-        # Accumulate total loss for epoch
-        loss += batch_loss
+        # Accumulate total loss for epoch as a float, so that each batch's
+        # autograd graph is freed once its backward pass is done
+        loss += batch_loss.item()
         # Average over number of non-padding datapoints before stepping
         batch_loss /= sum(lengths)
         batch_loss.backward()
@@ -140,15 +170,25 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
         optimizer.zero_grad()
         # Keep track of total number of time-points
         data_num += sum(lengths)
-        logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
-              format(batch_num, loss/data_num))
+        metrics.log('batch', epoch=epoch, batch=batch_num, loss=loss/data_num)
+        if batch_num % log_every == 0:
+            logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
+                  format(batch_num, loss/data_num))
         batch_num += 1
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
+    # Sum losses over processes when training distributed
+    if ddp.is_distributed():
+        loss, data_num = ddp.all_reduce_sum(float(loss), data_num)
+    elapsed = time.time() - start
     # Average losses and print
     loss /= data_num
     logger.info('---')
-    logger.info('Epoch: {}\tLoss: {:2.5f}'.format(epoch, loss))
+    logger.info('Epoch: {}\tLoss: {:2.5f}\tTime: {:.1f}s\tSpeed: {:.1f} steps/s'.\
+          format(epoch, loss, elapsed, data_num / elapsed))
+    memory = memoryStats.summary(count_tensors=args.log_memory)
+    logger.info('Memory\t' + memoryStats.format_summary(memory))
+    metrics.log('epoch', epoch=epoch, loss=loss, elapsed=elapsed, **memory)
     return loss
 
 def evaluateOnEval(input_data, input_target, lengths, model, criterion, args, fig_path=None):
@@ -170,12 +210,15 @@ def evaluateOnEval(input_data, input_target, lengths, model, criterion, args, fi
         for mod in list(data.keys()):
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
-        # Run forward pass
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         predictions.append(output.reshape(-1).tolist())
         actuals.append(target.reshape(-1).tolist())
         # Compute loss
-        loss += criterion(output, target)
+        loss += criterion(output, target).item()
         # Keep track of total number of time-points
         data_num += sum(lengths)
         # Compute correlation and CCC of predictions against ratings
@@ -192,7 +235,7 @@ def evaluateOnEval(input_data, input_target, lengths, model, criterion, args, fi
     loss /= data_num
     return ccc, predictions, actuals
 
-def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path=None):
+def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path=None, indices=None):
 
     # input_data = input_data['linguistic']
 
@@ -211,7 +254,8 @@ def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path
                                                             input_target,
                                                             lengths,
                                                             args,
-                                                            batch_size=1):
+                                                            batch_size=1,
+                                                            indices=indices):
 
         # send to device
         mask = mask.to(args.device)
@@ -219,10 +263,13 @@ def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path
         for mod in list(data.keys()):
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
-        # Run forward pass
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         # Compute loss
-        loss += criterion(output, target)
+        loss += criterion(output, target).item()
         # Keep track of total number of time-points
         data_num += sum(lengths)
         # Compute correlation and CCC of predictions against ratings
@@ -243,6 +290,14 @@ def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path
             local_best_ccc = curr_ccc
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
+    # Gather statistics from every process when evaluating distributed
+    if ddp.is_distributed():
+        loss, data_num = ddp.all_reduce_sum(float(loss), data_num)
+        corr = sum(ddp.all_gather(corr), [])
+        ccc = sum(ddp.all_gather(ccc), [])
+        local_best_ccc, local_best_output, local_best_target, local_best_index = \
+            max(ddp.all_gather((local_best_ccc, local_best_output, local_best_target, local_best_index)),
+                key=itemgetter(0))
     # Average losses and print
     loss /= data_num
     # Average statistics and print
@@ -331,27 +386,30 @@ def save_params(args, model, train_stats, test_stats):
     df.set_index('model')
     df.to_csv(fname, mode='a', header=(not os.path.exists(fname)), sep='\t')
 
-def save_checkpoint(modalities, mod_dimension, window_size, model, path):
-    checkpoint = {'modalities': modalities, 'mod_dimension' : mod_dimension, 'window_size' : window_size, 'model': model.state_dict()}
+def save_checkpoint(modalities, mod_dimension, window_size, model, path, state=None):
+    # state -- weight snapshot to save instead of the live model weights
+    if state is None:
+        state = model.state_dict()
+    checkpoint = {'modalities': modalities, 'mod_dimension' : mod_dimension, 'window_size' : window_size, 'model': state}
     torch.save(checkpoint, path)
 
 def load_checkpoint(path, device):
     checkpoint = torch.load(path, map_location=device)
     return checkpoint
 
-def load_data(modalities, data_dir, eval_dir=None):
+def load_data(modalities, data_dir, eval_dir=None, base_rate=2.0):
     print("Loading data...")
     if eval_dir == None:
         train_data = load_dataset(modalities, data_dir, 'Train',
-                                base_rate=args.base_rate,
+                                base_rate=base_rate,
                                 truncate=True, item_as_dict=True)
         test_data = load_dataset(modalities, data_dir, 'Valid',
-                                base_rate=args.base_rate,
+                                base_rate=base_rate,
                                 truncate=True, item_as_dict=True)
         print("Done.")
         return train_data, test_data
     eval_data = load_dataset(modalities, data_dir, eval_dir,
-                             base_rate=args.base_rate,
+                             base_rate=base_rate,
                              truncate=True, item_as_dict=True)
     print("Loading Eval Set Done.")
     return eval_data
@@ -544,7 +602,7 @@ def main(args):
     #     print("evaluating on the " + eval_dir + " Set.")
     #     TOP_COUNT = 6
     #     # this data will contain rating but will be excluded for usage
-    #     eval_data = load_data(args.modalities, args.data_dir, eval_dir)
+    #     eval_data = load_data(args.modalities, args.data_dir, eval_dir, base_rate=args.base_rate)
     #     input_features_eval, ratings_eval = constructInput(eval_data, channels=args.modalities, window_size=window_size)
     #     input_padded_eval, seq_lens_eval = padInput(input_features_eval, args.modalities, mod_dimension)
     #     ratings_padded_eval = padRating(ratings_eval, max(seq_lens_eval))
@@ -593,7 +651,7 @@ def main(args):
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
 
     # Load data for specified modalities
-    train_data, test_data = load_data(args.modalities, args.data_dir)
+    train_data, test_data = load_data(args.modalities, args.data_dir, base_rate=args.base_rate)
     # training data
     input_features_train, ratings_train = constructInput(train_data, channels=args.modalities, window_size=window_size)
     input_padded_train, seq_lens_train = padInput(input_features_train, args.modalities, mod_dimension)
@@ -608,34 +666,78 @@ def main(args):
     input_train = input_padded_train
     input_test = input_padded_test
 
+    # Data-parallel wrapper and sampler (no-ops unless distributed)
+    train_model = ddp.wrap(model)
+    sampler = ddp.train_sampler(len(seq_lens_train))
+
+    # Evaluate weight snapshots in a separate process if requested
+    evaluator = None
+    if args.async_eval:
+        model_fn = functools.partial(MultiCNNLSTM, mods=args.modalities, dims=mod_dimension,
+                                     device=torch.device('cpu'))
+        evaluator = AsyncEvaluator(model_fn, evaluate, (input_test, ratings_padded_test, seq_lens_test),
+                                   criterion, args, max_lag=args.eval_lag)
+
     # Train and save best model
     best_ccc = -1
     single_best_ccc = -1
     for epoch in range(1, args.epochs+1):
         print('---')
+        if sampler is not None:
+            sampler.set_epoch(epoch)
         train(input_train, ratings_padded_train, seq_lens_train,
-              model, criterion, optimizer, epoch, args)
+              train_model, criterion, optimizer, epoch, args, sampler)
+        results = []
         if epoch % args.eval_freq == 0:
-            with torch.no_grad():
-                pred, loss, stats, (local_best_output, local_best_target, local_best_index) =\
-                    evaluate(input_test, ratings_padded_test, seq_lens_test,
-                             model, criterion, args)
+            if evaluator is None:
+                with torch.no_grad():
+                    pred, loss, stats, local_best =\
+                        evaluate(input_test, ratings_padded_test, seq_lens_test,
+                                 model, criterion, args, indices=ddp.shard(len(seq_lens_test)))
+                results.append((epoch, None, loss, stats, local_best))
+            else:
+                evaluator.submit(epoch, model)
+        if evaluator is not None:
+            # results trail training by at most args.eval_lag snapshots
+            results += evaluator.collect(wait=(epoch == args.epochs))
+        for eval_epoch, state, loss, stats, (local_best_output, local_best_target, local_best_index) in results:
+            metrics.log('eval', epoch=eval_epoch, loss=loss, **stats)
+            if evaluator is not None:
+                logger.info('Evaluation (epoch {})\tLoss: {:2.5f}\tCCC: {:0.9f}'.\
+                format(eval_epoch, loss, stats['ccc']))
             if stats['ccc'] > best_ccc:
                 best_ccc = stats['ccc']
                 path = os.path.join("../ModelSave/B1-LSTM", 'B1-LSTM-A.pth')
-                save_checkpoint(args.modalities, mod_dimension, window_size, model, path)
+                if ddp.is_master():
+                    save_checkpoint(args.modalities, mod_dimension, window_size, model, path, state)
             if stats['max_ccc'] > single_best_ccc:
                 single_best_ccc = stats['max_ccc']
-                logger.info('===single_max_predict===')
-                logger.info(local_best_output)
-                logger.info(local_best_target)
-                logger.info(local_best_index)
-                logger.info('===end single_max_predict===')
+                # Prediction arrays go to a binary artifact, not the log
+                name = 'single_best'
+                metrics.log_arrays(name, output=local_best_output, target=local_best_target,
+                                   index=local_best_index)
+                logger.info('Single best sequence {} (epoch {}) saved as {}.npz'.\
+                format(local_best_index, eval_epoch, name))
             logger.info('CCC_STATS\tSINGLE_BEST: {:0.9f}\tBEST: {:0.9f}'.\
             format(single_best_ccc, best_ccc))
+    if evaluator is not None:
+        evaluator.close()
 
     return best_ccc
 
+def ddp_main(rank, args):
+    """Runs main() as one process of data-parallel CPU training."""
+    ddp.init_process(rank, args.world_size, args.master_port)
+    # Only rank 0 writes the log and checkpoints
+    if ddp.is_master():
+        setup_logging()
+    # gloo collectives run on CPU tensors
+    args.device = 'cpu'
+    try:
+        main(args)
+    finally:
+        ddp.cleanup()
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--modalities', type=str, default=None, nargs='+',
@@ -656,6 +758,20 @@ if __name__ == "__main__":
                         help='print loss N times every epoch (default: 5)')
     parser.add_argument('--eval_freq', type=int, default=1, metavar='N',
                         help='evaluate every N epochs (default: 1)')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='bfloat16 autocast for training and inference (default: false)')
+    parser.add_argument('--log_memory', action='store_true', default=False,
+                        help='also log live tensor counts every epoch (default: false)')
+    parser.add_argument('--async_eval', action='store_true', default=False,
+                        help='evaluate weight snapshots in a separate process (default: false)')
+    parser.add_argument('--eval_lag', type=int, default=2, metavar='N',
+                        help='max snapshots awaiting async evaluation (default: 2)')
+    parser.add_argument('--eval_threads', type=int, default=1, metavar='N',
+                        help='torch threads for the async evaluator (default: 1)')
+    parser.add_argument('--world_size', type=int, default=1, metavar='N',
+                        help='data-parallel CPU processes (default: 1)')
+    parser.add_argument('--master_port', type=int, default=29500, metavar='N',
+                        help='port for the gloo process group (default: 29500)')
     parser.add_argument('--save_freq', type=int, default=10, metavar='N',
                         help='save every N epochs (default: 10)')
     parser.add_argument('--device', type=str, default='cuda:0',
@@ -677,4 +793,10 @@ if __name__ == "__main__":
     parser.add_argument('--save_dir', type=str, default="./lstm_save",
                         help='path to save models and predictions')
     args = parser.parse_args()
-    main(args)
+    if args.world_size > 1:
+        if args.async_eval:
+            parser.error('--async_eval cannot be combined with --world_size > 1')
+        torch.multiprocessing.spawn(ddp_main, args=(args,), nprocs=args.world_size)
+    else:
+        setup_logging()
+        main(args)
@@ -0,0 +1,73 @@
+"""Helpers for multi-process data-parallel CPU training (gloo backend)."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+def init_process(rank, world_size, port=29500, threads=None):
+    """Joins the local process group and splits the cores between ranks."""
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // world_size)
+    torch.set_num_threads(threads)
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_master():
+    """Only rank 0 writes checkpoints and logs."""
+    return get_rank() == 0
+
+def wrap(model):
+    """Wraps model in DistributedDataParallel when running distributed."""
+    if not is_distributed():
+        return model
+    # Template modules (e.g. MultiTransformer.attn/ff) never get gradients
+    return DistributedDataParallel(model, find_unused_parameters=True)
+
+def train_sampler(num_samples, seed=1):
+    """Shuffling sampler giving every rank the same number of sequences."""
+    if not is_distributed():
+        return None
+    return DistributedSampler(range(num_samples), shuffle=True, seed=seed)
+
+def shard(num_samples):
+    """Indices of the evaluation sequences handled by this rank."""
+    if not is_distributed():
+        return None
+    return range(get_rank(), num_samples, get_world_size())
+
+def all_reduce_sum(*values):
+    """Sums scalar values over all ranks."""
+    if not is_distributed():
+        return values
+    total = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(total, op=dist.ReduceOp.SUM)
+    return tuple(total.tolist())
+
+def all_gather(obj):
+    """Returns the list of obj from every rank (picklable objects)."""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
@@ -2,10 +2,15 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import itertools
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from multiTransformer import UniTransformer, MultiTransformer, UniFullTransformer
+from collections import namedtuple
+from multiTransformer import UniTransformer, MultiTransformer, UniFullTransformer, run_branches, \
+    _autocast_enabled, _float_weights
 
 def pad_shift(x, shift, padv=0.0):
     """Shift 3D tensor forwards in time with padding."""
@@ -20,9 +25,61 @@ def pad_shift(x, shift, padv=0.0):
 
 def convolve(x, attn):
     """Convolve 3D tensor (x) with local attention weights (attn)."""
-    stacked = torch.stack([pad_shift(x, i) for
-                           i in range(attn.shape[2])], dim=-1)
-    return torch.sum(attn.unsqueeze(2) * stacked, dim=-1)
+    win_len = attn.shape[2]
+    # Pad the start of time once, then view every window of win_len steps
+    # (batch x seq_len x h_dim x win_len, oldest first) without copying
+    windows = F.pad(x, (0, 0, win_len-1, 0)).unfold(1, win_len, 1)
+    # attn[:,t,i] weights x[t-i], i.e. the window read backwards
+    return torch.einsum('bthk,btk->bth', windows, attn.flip(-1))
+
+def ar_scan(in_part, ar_weight, p_init):
+    """Solves p[t] = in_part[t] + sum_j ar_weight[t,j]*p[t-order+j] for all t.
+
+    The recursion is affine in the previous predictions, so each step is a
+    companion matrix and all predictions follow from their prefix products,
+    computed by a parallel (Hillis-Steele) scan in log2(seq_len) batched
+    matmuls. in_part is batch x seq_len x 1, ar_weight batch x seq_len x
+    order and p_init (the predictions before t = 0) batch x 1.
+    """
+    batch_size, seq_len, order = ar_weight.shape
+    # M[t] maps [p[t-order], ..., p[t-1], 1] to [p[t-order+1], ..., p[t], 1]
+    M = ar_weight.new_zeros(batch_size, seq_len, order+1, order+1)
+    M[:, :, :order-1, 1:order] = torch.eye(order-1).to(M.device)
+    M[:, :, order-1, :order] = ar_weight
+    M[:, :, order-1, order] = in_part[:, :, 0]
+    M[:, :, order, order] = 1
+    # After the scan M[t] = M[t] @ M[t-1] @ ... @ M[0]
+    shift = 1
+    while shift < seq_len:
+        M = torch.cat([M[:, :shift], torch.matmul(M[:, shift:], M[:, :-shift])], dim=1)
+        shift *= 2
+    init = torch.cat([p_init.expand(batch_size, order),
+                      torch.ones(batch_size, 1).to(M.device)], dim=1)
+    state = torch.matmul(M, init.view(batch_size, 1, order+1, 1))
+    return state[:, :, order-1]
+
+@torch.jit.script
+def _edlstm_decode(gxs: torch.Tensor, p: torch.Tensor, h: torch.Tensor,
+                   c: torch.Tensor, w_p: torch.Tensor, w_hh: torch.Tensor,
+                   b_hh: torch.Tensor, w1: torch.Tensor, b1: torch.Tensor,
+                   w2: torch.Tensor, b2: torch.Tensor):
+    """Decoder loop of MultiEDLSTM, compiled so it runs without the interpreter.
+
+    gxs holds the t x n x 4*h_dim input gates of the attended context and
+    w_p the input weights of the previous prediction p, which is fed back
+    through the out MLP (w1, b1, w2, b2) every step. Returns the t x n x 1
+    predictions and the final p, h and c.
+    """
+    t = gxs.size(0)
+    predicted = p.new_empty([t, p.size(0), 1])
+    for i in range(t):
+        gates = gxs[i] + F.linear(p, w_p) + F.linear(h, w_hh, b_hh)
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+        c = torch.sigmoid(forgetgate)*c + torch.sigmoid(ingate)*torch.tanh(cellgate)
+        h = torch.sigmoid(outgate)*torch.tanh(c)
+        p = F.linear(F.relu(F.linear(h, w1, b1)), w2, b2)
+        predicted[i] = p
+    return predicted, p, h, c
 
 class Highway(nn.Module):
 	def __init__(self, word_embed_size):
@@ -73,14 +130,14 @@ class CNN(nn.Module):
         x_conv = self.conv1d(x_reshape) # (batch_size, window_embed_size, m_word+k+1)
         # print(x_conv.shape)
         # x_conv_relu = nn.functional.relu(x_conv)
-        L = x_conv.size()[2]
-        maxpool = nn.MaxPool1d(L, stride=3)
-        x_conv_out = torch.squeeze(maxpool(x_conv), 2) # (batch_size, window_embed_size)
+        # Max over all positions; a MaxPool1d sized from the runtime length
+        # would freeze the frame count in traced graphs
+        x_conv_out = x_conv.max(dim=2)[0] # (batch_size, window_embed_size)
         return x_conv_out
 
 class MultiCNNTransformer(nn.Module):
-    def __init__(self, mods, dims, fuse_embed_size=512, k=2,
-                 device=torch.device('cuda:0')):
+    def __init__(self, mods, dims, fuse_embed_size=512, k=2, parallel=False,
+                 cached_windows=False, device=torch.device('cuda:0')):
         super(MultiCNNTransformer, self).__init__()
         # init
         self.mods = mods
@@ -98,33 +155,48 @@ class MultiCNNTransformer(nn.Module):
         # self.fusionLayer = nn.Linear(total_embed_size, fuse_embed_size)
         self.Transformer = UniFullTransformer(total_embed_size)
         self.dropout = nn.Dropout(p=0.3)
+        # Embed the modalities concurrently, see set_parallel()
+        self.parallel_branches = parallel
         # Store module in specified device (CUDA/CPU)
         self.device = (device if torch.cuda.is_available() else
                        torch.device('cpu'))
         self.to(self.device)
+        self.cache_windows(cached_windows)
 
-    def forward(self, inputs, length, mask=None):
+    def cache_windows(self, cached=True):
+        """Freezes the CNN/Highway window encoders and makes forward() take
+        their embed_windows() outputs, e.g. from embeddingCache, instead of
+        raw windows."""
+        self.cached_windows = cached
+        for mod in self.mods:
+            for param in itertools.chain(self.CNN[mod].parameters(),
+                                         self.Highway[mod].parameters()):
+                param.requires_grad = not cached
+
+    def embed_windows(self, inputs):
         '''
         inputs = (batch_size, 39, 33, 300)
+        Returns the (batch_size, 39, window_embed_size) window embeddings of
+        every modality, before dropout
         '''
         # CNN embedding
-        outputs = []
-        for mod in self.mods:
+        def branch(mod):
             inputs_mod = inputs[mod]
-            outputs_mod = []
-            # print(inputs_mod.shape)
-            for x in torch.split(inputs_mod, 1, 0):
-                # print('current memory allocated: {}'.format(torch.cuda.memory_allocated() / 1024 ** 2))
-                # print('max memory allocated: {}'.format(torch.cuda.max_memory_allocated() / 1024 ** 2))
-                # print('cached memory: {}'.format(torch.cuda.memory_cached() / 1024 ** 2))
-                x = torch.squeeze(x, 0) # input -> (39, 33, 300)
-                # print(x.permute(0, 2, 1).shape)
-                cnnOut = self.CNN[mod](x.permute(0, 2, 1)) # -> (39, 128)
-                x_highway = self.Highway[mod](cnnOut)
-                x_word_emb = self.dropout(x_highway)
-                outputs_mod.append(x_word_emb)
-            outputs_mod = torch.stack(outputs_mod, dim=0)
-            outputs.append(outputs_mod)
+            # All windows of the batch at once: (batch_size*39, 33, 300)
+            x = inputs_mod.flatten(0, 1)
+            cnnOut = self.CNN[mod](x.permute(0, 2, 1)) # -> (batch_size*39, 128)
+            x_highway = self.Highway[mod](cnnOut)
+            return x_highway.reshape(inputs_mod.size(0), inputs_mod.size(1), -1)
+        return run_branches(branch, self.mods, self.parallel_branches)
+
+    def forward(self, inputs, length, mask=None):
+        '''
+        inputs = (batch_size, 39, 33, 300), or embed_windows() outputs
+        when the window encoders are cached
+        '''
+        if not self.cached_windows:
+            inputs = self.embed_windows(inputs)
+        outputs = [self.dropout(inputs[mod]) for mod in self.mods]
         # Transformer with output headers
         if len(outputs) > 1:
             outputs = torch.cat(outputs, 2)
@@ -216,6 +288,10 @@ class MultiLSTM(nn.Module):
         target = target * mask.float()
         return target
 
+# Encoder LSTM state, the last attn_len encoder outputs (newest first),
+# the previous prediction and the decoder LSTM state of a MultiEDLSTM
+EDLSTMState = namedtuple('EDLSTMState', ['enc_h', 'enc_c', 'enc_out', 'p', 'dec_h', 'dec_c'])
+
 class MultiEDLSTM(nn.Module):
     """Multimodal encoder-decoder LSTM model.
 
@@ -225,11 +301,13 @@ class MultiEDLSTM(nn.Module):
     h_dim -- dimensions of LSTM hidden state
     n_layers -- number of LSTM layers
     attn_len -- length of local attention window
+    fused -- decode with the compiled _edlstm_decode loop
     """
 
     def __init__(self, window_embed_size, embed_dim=128, h_dim=512,
-                 n_layers=1, attn_len=3, device=torch.device('cuda:0')):
+                 n_layers=1, attn_len=3, fused=True, device=torch.device('cuda:0')):
         super(MultiEDLSTM, self).__init__()
+        self.fused = fused
         self.embed_dim = embed_dim
         self.h_dim = h_dim
         self.n_layers = n_layers
@@ -288,22 +366,69 @@ class MultiEDLSTM(nn.Module):
         h0 = self.dec_h0.repeat(1, batch_size, 1)
         c0 = self.dec_c0.repeat(1, batch_size, 1)
         # Use earlier predictions to predict next time-steps
-        predicted = []
         p = torch.ones(batch_size, 1).to(self.device) * tgt_init
-        h, c = h0, c0
-        for t in range(seq_len):
-            # Concatenate prediction from previous timestep to context
-            i = torch.cat([p, context[:,t,:]], dim=1).unsqueeze(1)
-            # Get next decoder LSTM state and output
-            o, (h, c) = self.decoder(i, (h, c))
-            # Computer prediction from output state
-            p = self.out(o.view(-1, self.h_dim))
-            predicted.append(p.unsqueeze(1))
-        predicted = torch.cat(predicted, dim=1)
+        predicted, _, _ = self.decode(context, p, (h0, c0))
         # Mask target entries that exceed sequence lengths
         predicted = predicted * mask.float()
         return predicted
 
+    def decode_step(self, p, context_t, hidden):
+        """Predicts one timestep from the previous prediction p and the
+        attended encoder context."""
+        # Concatenate prediction from previous timestep to context
+        i = torch.cat([p, context_t], dim=1).unsqueeze(1)
+        # Get next decoder LSTM state and output
+        o, hidden = self.decoder(i, hidden)
+        # Computer prediction from output state
+        p = self.out(o.view(-1, self.h_dim))
+        return p, hidden
+
+    def decode(self, context, p, hidden):
+        """Runs decode_step over the n x t x h_dim context, returns the
+        n x t x 1 predictions and the final p and hidden state."""
+        if self.fused and self.n_layers == 1 and not _autocast_enabled() \
+           and _float_weights(self.decoder, self.out[0], self.out[2]):
+            # Decoder inputs are [p, context_t], project the context at once
+            w_ih = self.decoder.weight_ih_l0
+            gxs = F.linear(context, w_ih[:, 1:], self.decoder.bias_ih_l0)
+            predicted, p, h, c = \
+                _edlstm_decode(gxs.transpose(0, 1), p, hidden[0][0], hidden[1][0],
+                               w_ih[:, :1], self.decoder.weight_hh_l0,
+                               self.decoder.bias_hh_l0, self.out[0].weight,
+                               self.out[0].bias, self.out[2].weight, self.out[2].bias)
+            return predicted.transpose(0, 1), p, (h.unsqueeze(0), c.unsqueeze(0))
+        predicted = []
+        for t in range(context.size(1)):
+            p, hidden = self.decode_step(p, context[:,t,:], hidden)
+            predicted.append(p.unsqueeze(1))
+        return torch.cat(predicted, dim=1), p, hidden
+
+    def init_state(self, batch_size, tgt_init=0.0):
+        """Initial state for batch_size sequences."""
+        return EDLSTMState(self.enc_h0.repeat(1, batch_size, 1),
+                           self.enc_c0.repeat(1, batch_size, 1),
+                           torch.zeros(batch_size, self.attn_len, self.h_dim).to(self.device),
+                           torch.ones(batch_size, 1).to(self.device) * tgt_init,
+                           self.dec_h0.repeat(1, batch_size, 1),
+                           self.dec_c0.repeat(1, batch_size, 1))
+
+    def step(self, inputs_t, state):
+        """
+        Advances state by one timestep of n x window_embed_size inputs,
+        returns the n x 1 prediction and the new state. The encoder and
+        the local attention only look back, so this matches forward() on
+        unpadded sequences; the module itself holds no state.
+        """
+        embed = self.embed(inputs_t)
+        attn = self.attn(embed)
+        enc_out, (enc_h, enc_c) = self.encoder(embed.unsqueeze(1), (state.enc_h, state.enc_c))
+        # Newest encoder output first, i.e. enc_out[:,k] is k steps back
+        enc_out = torch.cat([enc_out, state.enc_out[:, :-1]], dim=1)
+        # Same weighting as convolve() for a single timestep
+        context = torch.sum(attn.unsqueeze(1) * enc_out.transpose(1, 2), dim=-1)
+        p, (h, c) = self.decode_step(state.p, context, (state.dec_h, state.dec_c))
+        return p, EDLSTMState(enc_h, enc_c, enc_out, p, h, c)
+
 class MultiARLSTM(nn.Module):
     """Multimodal LSTM model with auto-regressive final layer.
 
@@ -314,11 +439,13 @@ class MultiARLSTM(nn.Module):
     n_layers -- number of LSTM layers
     attn_len -- length of local attention window
     ar_order -- autoregressive order (i.e. length of AR window)
+    scan -- in eval mode, solve the AR recursion with ar_scan
     """
 
     def __init__(self, window_embed_size, embed_dim=128, h_dim=512, n_layers=1,
-                 attn_len=7, ar_order=1, device=torch.device('cuda:0')):
+                 attn_len=7, ar_order=1, scan=True, device=torch.device('cuda:0')):
         super(MultiARLSTM, self).__init__()
+        self.scan = scan
         self.embed_dim = embed_dim
         self.h_dim = h_dim
         self.n_layers = n_layers
@@ -381,6 +508,10 @@ class MultiARLSTM(nn.Module):
                                       i in range(self.ar_order)], dim=-1)
             ar_part = torch.sum(ar_weight.unsqueeze(2) * ar_stacked, dim=-1)
             predicted = in_part + ar_part
+        elif self.scan and not self.training:
+            # Own predictions, with all AR coefficients known up front
+            p_init = torch.ones(batch_size, 1).to(self.device) * tgt_init
+            predicted = ar_scan(in_part, ar_weight, p_init)
         else:
             # Otherwise use own predictions
             p_init = torch.ones(batch_size, 1).to(self.device) * tgt_init
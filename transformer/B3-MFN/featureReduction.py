@@ -0,0 +1,141 @@
+"""Load-time linear reduction of high-dimensional frame features."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+
+import numpy as np
+import torch
+
+from datasets import load_dataset
+from embeddingCache import manifest_hash
+
+METHODS = ['pca', 'random']
+
+class Projection(object):
+    """
+    Linear map of dim_in feature vectors to dim_out: (x - mean) . components^T.
+    NaN features are zeroed first, as videoInputHelper would do later.
+    """
+
+    def __init__(self, mean, components, explained=None):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.components = np.asarray(components, dtype=np.float64)
+        # Fraction of the fitted variance kept (PCA only)
+        self.explained = explained
+
+    @property
+    def dim_out(self):
+        return self.components.shape[0]
+
+    def __call__(self, frames):
+        x = np.nan_to_num(np.asarray(frames, dtype=np.float64))
+        return np.dot(x - self.mean, self.components.T).astype(np.float32)
+
+    def save(self, path):
+        # Write under a private name and rename, so concurrent processes
+        # never read a partial file
+        tmp_path = '{}.tmp-{}.npz'.format(path, os.getpid())
+        explained = np.nan if self.explained is None else self.explained
+        np.savez(tmp_path, mean=self.mean, components=self.components,
+                 explained=explained)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        explained = float(arrays['explained'])
+        return cls(arrays['mean'], arrays['components'],
+                   None if np.isnan(explained) else explained)
+
+def fit_pca(sequences, dim):
+    """
+    Principal components of the frames of sequences (lists of feature
+    vectors, None for missing ones), accumulated one sequence at a time, so
+    memory is the dim_in x dim_in scatter matrix rather than every frame.
+    """
+    count, total, scatter = 0, None, None
+    for frames in sequences:
+        if frames is None or len(frames) == 0:
+            continue
+        x = np.nan_to_num(np.asarray(frames, dtype=np.float64))
+        if total is None:
+            total = np.zeros(x.shape[1])
+            scatter = np.zeros((x.shape[1], x.shape[1]))
+        count += len(x)
+        total += x.sum(0)
+        scatter += np.dot(x.T, x)
+    mean = total / count
+    covariance = scatter / count - np.outer(mean, mean)
+    values, vectors = np.linalg.eigh(covariance)
+    # eigh sorts ascending
+    order = np.argsort(values)[::-1][:dim]
+    explained = values[order].sum() / values.sum()
+    return Projection(mean, vectors[:, order].T, float(explained))
+
+def random_projection(dim_in, dim, seed=1):
+    """Gaussian random projection scaled by 1/sqrt(dim), which preserves
+    distances in expectation (Johnson-Lindenstrauss)."""
+    rng = np.random.RandomState(seed)
+    components = rng.normal(0.0, 1.0 / np.sqrt(dim), size=(dim, dim_in))
+    return Projection(np.zeros(dim_in), components)
+
+def load_projection(method, dim, data_dir, cache_dir, mod='image', dim_in=1000,
+                    base_rate=2.0, seed=1, train_data=None):
+    """
+    Projection of mod features to dim, read from cache_dir next to the
+    window embedding cache. On a miss, 'pca' is fitted on the Train split
+    (train_data if given, otherwise loaded from data_dir) and 'random'
+    is drawn from seed; either is then saved there.
+    """
+    if method not in METHODS:
+        raise ValueError("unknown reduction method: {}".format(method))
+    manifest = dict(mod=mod, method=method, dim=dim, dim_in=dim_in, seed=seed)
+    if method == 'pca':
+        manifest.update(data_dir=os.path.abspath(data_dir), split='Train',
+                        base_rate=base_rate)
+    path = os.path.join(cache_dir, 'projection-{}-{}{}-{}.npz'.format(
+        mod, method, dim, manifest_hash(**manifest)[:16]))
+    if os.path.exists(path):
+        return Projection.load(path)
+    if method == 'pca':
+        if train_data is None:
+            train_data = load_dataset([mod], data_dir, 'Train', base_rate=base_rate,
+                                      truncate=True, item_as_dict=True)
+        projection = fit_pca(train_data.data[mod], dim)
+    else:
+        projection = random_projection(dim_in, dim, seed)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    projection.save(path)
+    return projection
+
+def reduction_entry(method, projection, mod='image'):
+    """Checkpoint entry recording that the model's mod features were
+    projected; apply_reduction() repeats that for the checkpoint's users.
+    Arrays are kept as tensors, which torch.load accepts with weights_only."""
+    return {'mod': mod, 'method': method, 'dim': projection.dim_out,
+            'mean': torch.from_numpy(projection.mean),
+            'components': torch.from_numpy(projection.components),
+            'explained': projection.explained}
+
+def entry_projection(reduction):
+    return Projection(reduction['mean'].cpu().numpy(), reduction['components'].cpu().numpy(),
+                      reduction['explained'])
+
+def apply_reduction(reduction, *datasets):
+    """Projects the datasets as the model saved with the reduction entry
+    was trained on, e.g. if 'reduction' in checkpoint."""
+    reduce_features(entry_projection(reduction), reduction['mod'], *datasets)
+
+def reduce_features(projection, mod, *datasets):
+    """Replaces the mod frames of every sequence of each dataset by their
+    projection, in place, before windowing."""
+    for dataset in datasets:
+        reduced = [None if frames is None else projection(frames)
+                   for frames in dataset.data[mod]]
+        # The raw arrays kept in orig are only read back for the ratings
+        dataset.orig[mod] = reduced
+        dataset.data[mod] = [None if r is None else r.tolist() for r in reduced]
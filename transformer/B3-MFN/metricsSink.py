@@ -0,0 +1,95 @@
+"""Buffered metrics written to disk by a background thread."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os, time
+import atexit
+import json
+import queue
+import threading
+
+import numpy as np
+
+class MetricsSink(object):
+    """Collects scalar metrics and array dumps off the training thread.
+
+    Scalars are appended to a line-delimited JSON file, one record per
+    line, and arrays are saved as .npz files in a separate directory.
+    Calls are no-ops until open(), so processes that never open the sink
+    (async evaluation workers, non-master ranks) pay nothing for them.
+
+    flush_interval -- seconds between writes of the buffered records
+    """
+
+    def __init__(self, flush_interval=2.0):
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.thread = None
+
+    def open(self, path, array_dir, mode='w'):
+        """Starts writing scalars to path and arrays into array_dir."""
+        if not os.path.isdir(array_dir):
+            os.makedirs(array_dir)
+        self.array_dir = array_dir
+        self.file = open(path, mode)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, event, **values):
+        """Records scalar values (numbers or strings) under an event name."""
+        if self.queue is None:
+            return
+        values['event'] = event
+        values['time'] = time.time()
+        self.queue.put(('scalars', values))
+
+    def log_arrays(self, name, **arrays):
+        """Saves arrays to <array_dir>/<name>.npz, replacing earlier dumps."""
+        if self.queue is None:
+            return
+        self.queue.put(('arrays', (name, arrays)))
+
+    def _write(self, kind, item):
+        if kind == 'scalars':
+            # default=float covers numpy scalars
+            self.file.write(json.dumps(item, default=float) + '\n')
+            return
+        name, arrays = item
+        path = os.path.join(self.array_dir, name + '.npz')
+        # Write then rename so readers never see a partial file
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, **{k: np.asarray(v) for k, v in arrays.items()})
+        os.replace(path + '.tmp', path)
+
+    def _run(self):
+        done = False
+        while not done:
+            items = [self.queue.get()]
+            # Drain everything queued since the last write
+            try:
+                while True:
+                    items.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            for item in items:
+                if item is None:
+                    done = True
+                    continue
+                self._write(*item)
+            self.file.flush()
+            if not done:
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """Writes out the remaining records and stops the writer thread."""
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.queue = None
+        self.thread = None
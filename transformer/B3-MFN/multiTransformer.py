@@ -2,8 +2,13 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 import math, copy, time
+from collections import namedtuple
 from torch.autograd import Variable
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import matplotlib.pyplot as plt
 
 class PositionwiseFeedForward(nn.Module):
@@ -33,18 +38,85 @@ def attention(query, key, value, mask=None, dropout=None):
         p_attn = dropout(p_attn)
     return torch.matmul(p_attn, value), p_attn
 
+def fused_attention(query, key, value, mask=None, dropout_p=0.0):
+    '''
+    Same as attention() through F.scaled_dot_product_attention, without
+    materializing the attention weights
+    '''
+    if mask is None:
+        return F.scaled_dot_product_attention(query, key, value, dropout_p=dropout_p)
+    keep = mask != 0
+    # attention() gives rows with every key masked uniform weights, i.e.
+    # the mean of value; let SDPA see all keys there and patch them after
+    empty = ~keep.any(dim=-1, keepdim=True)
+    x = F.scaled_dot_product_attention(query, key, value, attn_mask=keep | empty,
+                                       dropout_p=dropout_p)
+    return torch.where(empty, value.mean(dim=-2, keepdim=True), x)
+
+def local_attention(query, key, value, window, n_global=0, mask=None, dropout=None):
+    '''
+    attention() restricted to keys at most window steps away, plus
+    n_global leading timesteps that attend to and are attended by every
+    timestep. mask, if given, masks keys (batch x 1 x 1 x T). Time and
+    memory are O(T*(window + n_global)) instead of O(T^2)
+    '''
+    nbatches, h, T, d_k = query.size()
+    width = 2*window + 1
+    # batch x h x T x d_k x width views of the keys/values around each step
+    def band(x):
+        return F.pad(x, (0, 0, window, window)).unfold(2, width, 1)
+    # Key position of every band slot, masked outside the sequence and
+    # on global keys (those are scored separately below)
+    pos = torch.arange(T, device=query.device).unsqueeze(1) \
+          + torch.arange(-window, window + 1, device=query.device)
+    allowed = (pos >= n_global) & (pos < T)
+    if mask is not None:
+        keep = mask.reshape(nbatches, 1, T).float()
+        allowed = allowed & (F.pad(keep, (window, window)).unfold(2, width, 1) != 0)
+    scores = torch.einsum('bhtd,bhtdw->bhtw', query, band(key)) / math.sqrt(d_k)
+    scores = scores.masked_fill(~allowed, -1e9)
+    if n_global > 0:
+        global_scores = torch.matmul(query, key[:, :, :n_global].transpose(-2, -1)) \
+                        / math.sqrt(d_k)
+        if mask is not None:
+            global_scores = global_scores.masked_fill(keep[:, :, :n_global].unsqueeze(1) == 0, -1e9)
+        scores = torch.cat([global_scores, scores], dim=-1)
+    p_attn = F.softmax(scores, dim=-1)
+    if dropout is not None:
+        p_attn = dropout(p_attn)
+    x = torch.einsum('bhtw,bhtdw->bhtd', p_attn[..., n_global:], band(value))
+    if n_global > 0:
+        x = x + torch.matmul(p_attn[..., :n_global], value[:, :, :n_global])
+        # Global timesteps attend to the whole sequence
+        x_global, _ = attention(query[:, :, :n_global], key, value, mask=mask,
+                                dropout=dropout)
+        x = torch.cat([x_global, x[:, :, n_global:]], dim=2)
+    return x
+
 class MultiHeadedAttention(nn.Module):
-    def __init__(self, h, d_model, dropout=0.1):
+    def __init__(self, h, d_model, dropout=0.1, store_attn=False,
+                 window=None, n_global=0):
         super(MultiHeadedAttention, self).__init__()
         assert d_model % h == 0
         # We assume d_v always equals d_k
         self.d_k = d_model // h
         self.h = h
         self.linears = clones(nn.Linear(d_model, d_model), 4)
+        # Keep the attention weights of the last forward in self.attn
+        # (needs the unfused path)
+        self.store_attn = store_attn
         self.attn = None
+        # Attend within window steps (plus n_global global steps) if set
+        self.window = window
+        self.n_global = n_global
         self.dropout = nn.Dropout(p=dropout)
+        # Optional (h,) scale of each head's output, whose gradient tells
+        # how much the head matters (see prune.py)
+        self.head_gate = None
 
-    def forward(self, query, key, value, mask=None):
+    def forward(self, query, key, value, mask=None, lengths=None):
+        if lengths is not None:
+            return self._forward_packed(query, key, value, lengths)
         if mask is not None:
             # Same mask applied to all h heads.
             mask = mask.unsqueeze(1)
@@ -56,24 +128,147 @@ class MultiHeadedAttention(nn.Module):
              for l, x in zip(self.linears, (query, key, value))]
 
         # 2) Apply attention on all the projected vectors in batch.
-        x, self.attn = attention(query, key, value, mask=mask,
-                                 dropout=self.dropout)
+        if self.window is not None:
+            x = local_attention(query, key, value, self.window, self.n_global,
+                                mask=mask, dropout=self.dropout)
+        elif self.store_attn or not hasattr(F, 'scaled_dot_product_attention'):
+            x, self.attn = attention(query, key, value, mask=mask,
+                                     dropout=self.dropout)
+        else:
+            x = fused_attention(query, key, value, mask=mask,
+                                dropout_p=self.dropout.p if self.training else 0.0)
+
+        if self.head_gate is not None:
+            x = x * self.head_gate.view(1, -1, 1, 1)
 
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous() \
              .view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)
 
+    def _forward_packed(self, query, key, value, lengths):
+        """Self-attention within each sequence of packed (sum(lengths),
+        d_model) inputs, whose rows hold one sequence after another."""
+        # h x sum(lengths) x d_k projections
+        query, key, value = \
+            [l(x).view(-1, self.h, self.d_k).transpose(0, 1)
+             for l, x in zip(self.linears, (query, key, value))]
+        x = []
+        for q, k, v in zip(query.split(lengths, 1), key.split(lengths, 1),
+                           value.split(lengths, 1)):
+            if self.window is not None:
+                x.append(local_attention(q.unsqueeze(0), k.unsqueeze(0), v.unsqueeze(0),
+                                         self.window, self.n_global,
+                                         dropout=self.dropout).squeeze(0))
+            elif hasattr(F, 'scaled_dot_product_attention'):
+                x.append(F.scaled_dot_product_attention(
+                    q, k, v, dropout_p=self.dropout.p if self.training else 0.0))
+            else:
+                x.append(attention(q, k, v, dropout=self.dropout)[0])
+        x = torch.cat(x, dim=1)
+        if self.head_gate is not None:
+            x = x * self.head_gate.view(-1, 1, 1)
+        x = x.transpose(0, 1).contiguous() \
+             .view(-1, self.h * self.d_k)
+        return self.linears[-1](x)
+
+    def prune_heads(self, heads):
+        """Keeps only the given heads, shrinking the projections to them."""
+        index = torch.cat([torch.arange(i*self.d_k, (i+1)*self.d_k) for i in sorted(heads)])
+        index = index.to(self.linears[0].weight.device)
+        for l in self.linears[:3]:
+            _prune_linear(l, index, 0)
+        _prune_linear(self.linears[-1], index, 1)
+        self.h = len(heads)
+        self.attn = None
+
 class Encoder(nn.Module):
-    def __init__(self, layer, N):
+    def __init__(self, layer, N, varlen=False, checkpoint=0):
         super(Encoder, self).__init__()
         self.layers = clones(layer, N)
         self.norm = LayerNorm(layer.size)
+        # Skip padded timesteps altogether, see set_varlen()
+        self.varlen = varlen
+        # Layers per checkpointed segment (0 stores all), see set_checkpoint()
+        self.checkpoint = checkpoint
 
     def forward(self, x, mask):
-        for layer in self.layers:
-            x = layer(x, mask)
-        return self.norm(x)
+        # mask is batch x seq_len x 1 and marks the real timesteps
+        if self.varlen:
+            return self._forward_packed(x, mask)
+        # Mask padded keys: batch x 1 x seq_len
+        mask = mask.transpose(-2, -1)
+        return self.norm(self._run_layers(x, mask))
+
+    def _forward_packed(self, x, mask):
+        """Runs the layers on the real timesteps only, packed one sequence
+        after another; padded outputs are zero."""
+        real = mask.squeeze(-1) != 0
+        lengths = real.sum(dim=1).tolist()
+        packed = self.norm(self._run_layers(x[real], None, lengths))
+        output = packed.new_zeros(x.size())
+        output[real] = packed
+        return output
+
+    def _run_layers(self, x, mask, lengths=None):
+        """Applies the layers. While training with checkpointing on, only
+        the input of each segment of self.checkpoint layers is kept for
+        backward and the segment is recomputed from it."""
+        if self.checkpoint > 0 and self.training and torch.is_grad_enabled():
+            for start in range(0, len(self.layers), self.checkpoint):
+                x = torch.utils.checkpoint.checkpoint(
+                    self._run_segment, x, mask, lengths, start, self.checkpoint,
+                    use_reentrant=False)
+            return x
+        return self._run_segment(x, mask, lengths, 0, len(self.layers))
+
+    def _run_segment(self, x, mask, lengths, start, size):
+        for layer in self.layers[start:start+size]:
+            x = layer(x, mask, lengths)
+        return x
+
+    def prune_layers(self, layers):
+        """Keeps only the given layers, in order."""
+        self.layers = nn.ModuleList([self.layers[i] for i in sorted(layers)])
+
+def set_varlen(model, varlen=True):
+    """Switches every Encoder in model to variable-length execution."""
+    for module in model.modules():
+        if isinstance(module, Encoder):
+            module.varlen = varlen
+
+def set_checkpoint(model, layers=1):
+    """Checkpoints every Encoder in model in segments of layers encoder
+    layers while training, trading a second forward pass of each segment
+    for its stored activations; 0 switches checkpointing off."""
+    for module in model.modules():
+        if isinstance(module, Encoder):
+            module.checkpoint = layers
+
+def encoder_structure(model):
+    """Heads of every layer of every Encoder in model, by module name."""
+    return {name: [layer.self_attn.h for layer in module.layers]
+            for name, module in model.named_modules() if isinstance(module, Encoder)}
+
+def apply_structure(model, structure):
+    """Shrinks the Encoders of a freshly constructed model to a structure
+    from encoder_structure() of a pruned one, whose state dict then loads."""
+    for name, heads in structure.items():
+        encoder = model.get_submodule(name)
+        encoder.prune_layers(range(len(heads)))
+        for layer, h in zip(encoder.layers, heads):
+            if h < layer.self_attn.h:
+                layer.self_attn.prune_heads(range(h))
+
+def _prune_linear(linear, index, dim):
+    """Keeps the output (dim 0) or input (dim 1) features of linear at index."""
+    linear.weight = nn.Parameter(linear.weight.detach().index_select(dim, index).clone())
+    if dim == 0:
+        if linear.bias is not None:
+            linear.bias = nn.Parameter(linear.bias.detach().index_select(0, index).clone())
+        linear.out_features = len(index)
+    else:
+        linear.in_features = len(index)
 
 def clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for _ in range(N)])
@@ -111,14 +306,104 @@ class EncoderLayer(nn.Module):
         self.sublayer = clones(SublayerConnection(size, dropout), 2)
         self.size = size
 
-    def forward(self, x, mask):
-        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask))
+    def forward(self, x, mask, lengths=None):
+        x = self.sublayer[0](x, lambda x: self.self_attn(x, x, x, mask, lengths))
         return self.sublayer[1](x, self.feed_forward)
 
+def _autocast_enabled():
+    return torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled()
+
+def _float_weights(*modules):
+    """Whether modules are still float layers, whose weights the compiled
+    paths read directly (dynamic quantization replaces them)."""
+    return all(type(m) in (nn.Linear, nn.LSTM, nn.LSTMCell) for m in modules)
+
+def present_mods(mods, inputs):
+    """Modalities of mods that have inputs. A missing modality is absent
+    from inputs or None, and its branch is skipped."""
+    return [mod for mod in mods if inputs.get(mod) is not None]
+
+def _linear_t(x: torch.Tensor, w_t: torch.Tensor, b: torch.Tensor):
+    """F.linear(x, w_t.t(), b) of n x in_features x, written for the ONNX
+    exporter: it drops the transpose of a list element, whose rank it does
+    not know, and takes the dtype of the sum from its first operand."""
+    return b + torch.matmul(x, w_t)
+
+def _masked(x: torch.Tensor, mask: torch.Tensor, i: int):
+    """x times step i of a _dropout_masks() mask; empty means no dropout."""
+    if mask.size(0) == 0:
+        return x
+    return x * mask[i]
+
+@torch.jit.script
+def _mfn_recurrence(gxs: List[torch.Tensor], hs: List[torch.Tensor],
+                    cs: List[torch.Tensor], mem: torch.Tensor,
+                    hh_params: List[torch.Tensor],
+                    mlp_params: List[torch.Tensor], masks: List[torch.Tensor]):
+    """
+    MFN recurrence over t steps, compiled so the loop runs without the
+    interpreter. gxs holds the t x n x 4*hidden input-to-hidden gates of
+    every cell and hh_params their w_hh and b_hh in turn (flat, as
+    tracing cannot pass nested lists), mlp_params the weights and biases
+    of att1, att2, gamma1 and gamma2 (fc1 then fc2 each) and masks their
+    dropout noise, see MFN._dropout_masks(). Weights come transposed, see
+    _linear_t(). A cell whose gxs has no steps belongs to a missing
+    modality and keeps its state. Returns the t x n x sum(hidden) hidden
+    states and t x n x mem memories, followed by the final hs, cs and mem.
+    """
+    t = 0
+    for gx in gxs:
+        t = max(t, gx.size(0))
+    # Stacked once at the end: ONNX export mis-sizes steps written into
+    # a preallocated t x n x d buffer
+    all_hs = []
+    all_mems = []
+    p = mlp_params
+    for i in range(t):
+        new_hs = []
+        new_cs = []
+        for m in range(len(gxs)):
+            if gxs[m].size(0) == 0:
+                new_hs.append(hs[m])
+                new_cs.append(cs[m])
+                continue
+            # Rest of an LSTMCell step, in the same order as ATen's
+            gates = _linear_t(hs[m], hh_params[2*m], hh_params[2*m+1]) + gxs[m][i]
+            ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+            c = torch.sigmoid(forgetgate)*cs[m] + torch.sigmoid(ingate)*torch.tanh(cellgate)
+            h = torch.sigmoid(outgate)*torch.tanh(c)
+            new_hs.append(h)
+            new_cs.append(c)
+        cStar = torch.cat([torch.cat(cs, dim=1), torch.cat(new_cs, dim=1)], dim=1)
+        attention = F.softmax(_linear_t(_masked(F.relu(_linear_t(cStar, p[0], p[1])),
+                                                masks[0], i), p[2], p[3]), dim=1)
+        attended = attention*cStar
+        cHat = torch.tanh(_linear_t(_masked(F.relu(_linear_t(attended, p[4], p[5])),
+                                            masks[1], i), p[6], p[7]))
+        both = torch.cat([attended, mem], dim=1)
+        gamma1 = torch.sigmoid(_linear_t(_masked(F.relu(_linear_t(both, p[8], p[9])),
+                                                 masks[2], i), p[10], p[11]))
+        gamma2 = torch.sigmoid(_linear_t(_masked(F.relu(_linear_t(both, p[12], p[13])),
+                                                 masks[3], i), p[14], p[15]))
+        mem = gamma1*mem + gamma2*cHat
+        hs = new_hs
+        cs = new_cs
+        all_hs.append(torch.cat(hs, dim=1))
+        all_mems.append(mem)
+    return torch.stack(all_hs), torch.stack(all_mems), hs, cs, mem
+
+# Per-modality LSTM hidden and cell states (lists in mods order) and the
+# multi-view gated memory of an MFN
+MFNState = namedtuple('MFNState', ['h', 'c', 'mem'])
+
 class MFN(nn.Module):
-    def __init__(self, mods, dims, output_dim,
+    def __init__(self, mods, dims, output_dim, fused=True, block_diag=False,
                  device=torch.device('cuda:0')):
         super(MFN, self).__init__()
+        # run the recurrence through the scripted _mfn_recurrence
+        self.fused = fused
+        # with fused, step all modality cells as one block-diagonal cell
+        self.block_diag = block_diag
 
         # input dims
         self.mods = mods
@@ -178,74 +463,206 @@ class MFN(nn.Module):
                        torch.device('cpu'))
         self.to(self.device)
 
+    def init_state(self, batch_size):
+        """Zero state for batch_size sequences."""
+        return MFNState([torch.zeros(batch_size, self.hidden_dim[mod], device=self.device) for mod in self.mods],
+                        [torch.zeros(batch_size, self.hidden_dim[mod], device=self.device) for mod in self.mods],
+                        torch.zeros(batch_size, self.mem_dim, device=self.device))
+
     def forward(self, inputs):
         # each input is t x n x d
-        n = -1
-        t = -1
-        # construct needs for each mods
-        # TODO: this assume cuda is avaliable?
-        self.h = dict()
-        self.c = dict()
+        n = inputs[present_mods(self.mods, inputs)[0]].size(1)
+        outputs, _ = self.run(inputs, self.init_state(n))
+        return outputs
+
+    def step(self, inputs_t, state):
+        """
+        Advances state by one timestep of n x d inputs (one per present
+        modality). Returns the n x output_dim prediction and the new state;
+        the module itself holds no state, so one model can serve many
+        sequences.
+        """
+        inputs = {mod: inputs_t[mod].unsqueeze(0) for mod in present_mods(self.mods, inputs_t)}
+        outputs, state = self.run(inputs, state)
+        return outputs[:, 0], state
+
+    def run(self, inputs, state):
+        """
+        Runs t x n x d inputs starting from state, returns the n x t x
+        output_dim predictions and the state after the last step. The
+        cells of missing modalities keep their state.
+        """
+        # TorchScript does not follow eager autocast, and the recurrence
+        # needs float weights, so keep the loop for both
+        if self.fused and not _autocast_enabled() and _float_weights(
+                self.att1_fc1, self.att1_fc2, self.att2_fc1, self.att2_fc2,
+                self.gamma1_fc1, self.gamma1_fc2, self.gamma2_fc1, self.gamma2_fc2,
+                *[self.lstm[mod] for mod in self.mods]):
+            return self._run_fused(inputs, state)
+        return self._run_loop(inputs, state)
+
+    def _run_fused(self, inputs, state):
+        hs, cs, mem = list(state.h), list(state.c), state.mem
+        # Input-to-hidden gates do not depend on the recurrence, so they are
+        # computed for all t steps with one GEMM per modality up front
+        # Missing modalities get no steps, which skips their cells
+        gxs = [F.linear(inputs[mod], self.lstm[mod].weight_ih, self.lstm[mod].bias_ih)
+               if inputs.get(mod) is not None else mem.new_empty(0)
+               for mod in self.mods]
+        hh_params = [p for mod in self.mods
+                     for p in (self.lstm[mod].weight_hh.t(), self.lstm[mod].bias_hh)]
+        block_diag = self.block_diag and len(present_mods(self.mods, inputs)) == len(self.mods)
+        if block_diag:
+            gxs, hh_params = self._block_diag_cell(gxs, hh_params)
+            hs, cs = [torch.cat(hs, dim=1)], [torch.cat(cs, dim=1)]
+        mlp_params = []
+        for fc in [self.att1_fc1, self.att1_fc2, self.att2_fc1, self.att2_fc2,
+                   self.gamma1_fc1, self.gamma1_fc2, self.gamma2_fc1, self.gamma2_fc2]:
+            mlp_params += [fc.weight.t(), fc.bias]
+        masks = self._dropout_masks(max(gx.size(0) for gx in gxs), mem)
+        all_hs, all_mems, hs, cs, mem = \
+            _mfn_recurrence(gxs, hs, cs, mem, hh_params, mlp_params, masks)
+        if block_diag:
+            hidden = [self.hidden_dim[mod] for mod in self.mods]
+            hs, cs = hs[0].split(hidden, dim=1), cs[0].split(hidden, dim=1)
+        return self._output(all_hs, all_mems), MFNState(list(hs), list(cs), mem)
+
+    def _dropout_masks(self, t, mem):
+        """
+        t x n x d dropout noise of the att1, att2, gamma1 and gamma2 hidden
+        layers, drawn as nn.Dropout would draw it (bernoulli, then scaled)
+        step by step in _run_loop's order, so that both paths consume the
+        random numbers alike. Empty for layers that drop nothing.
+        """
+        layers = [(self.att1_dropout, self.att1_fc1), (self.att2_dropout, self.att2_fc1),
+                  (self.gamma1_dropout, self.gamma1_fc1), (self.gamma2_dropout, self.gamma2_fc1)]
+        drawn = [self.training and dropout.p > 0 for dropout, _ in layers]
+        noise = [[] for _ in layers]
+        for i in range(t):
+            for k, (dropout, fc) in enumerate(layers):
+                if drawn[k]:
+                    noise[k].append(mem.new_empty(mem.size(0), fc.out_features)
+                                    .bernoulli_(1 - dropout.p).div_(1 - dropout.p))
+        return [torch.stack(steps) if steps else mem.new_empty(0) for steps in noise]
+
+    def _block_diag_cell(self, gxs, hh_params):
+        """
+        Packs the modality cells into one cell over the concatenated
+        hidden state, whose hidden-to-hidden weight is block diagonal.
+        Gates are laid out gate-major (i, f, g, o of all modalities in
+        turn) as LSTMCell expects. Built from the lstm_{mod} parameters on
+        every call, so the state dict stays per modality.
+        """
+        hidden = [self.hidden_dim[mod] for mod in self.mods]
+        gx, w_hh, b_hh = [], [], []
+        for k in range(4):
+            gx += [g[:, :, k*h:(k+1)*h] for g, h in zip(gxs, hidden)]
+            w_hh.append(torch.block_diag(*[w[:, k*h:(k+1)*h] for w, h in zip(hh_params[0::2], hidden)]))
+            b_hh += [b[k*h:(k+1)*h] for b, h in zip(hh_params[1::2], hidden)]
+        return [torch.cat(gx, dim=2)], [torch.cat(w_hh, dim=1), torch.cat(b_hh)]
+
+    def _output(self, all_hs, all_mems):
+        """Output MLP over the t x n x d hidden and memory histories at once,
+        returns n x t x output_dim."""
+        last_hs = torch.cat([all_hs, all_mems], dim=2)
+        outputs = self.out_fc2(self.out_dropout(F.relu(self.out_fc1(last_hs))))
+        return outputs.transpose(0, 1)
+
+    def _run_loop(self, inputs, state):
+        t = inputs[present_mods(self.mods, inputs)[0]].size(0)
+        h = dict(zip(self.mods, state.h))
+        c = dict(zip(self.mods, state.c))
+        mem = state.mem
         all_hs = dict()
-        all_cs = dict()
         all_mems = []
         for mod in self.mods:
-            input_mod = inputs[mod]
-            n = input_mod.size()[1]
-            t = input_mod.size()[0]
-            self.h[mod] = torch.zeros(n, self.hidden_dim[mod]).to(self.device)
-            self.c[mod] = torch.zeros(n, self.hidden_dim[mod]).to(self.device)
-        self.mem = torch.zeros(n, self.mem_dim).to(self.device)
+            all_hs[mod] = []
 
         for i in range(t):
-            # prev time step
-            prev_c = dict()
-            for mod in self.mods:
-                prev_c[mod] = self.c[mod]
             new_h = dict()
             new_c = dict()
             for mod in self.mods:
-                new_h[mod], new_c[mod] = self.lstm[mod](inputs[mod][i], (self.h[mod], self.c[mod]))
+                if inputs.get(mod) is None:
+                    # Missing modality keeps its state
+                    new_h[mod], new_c[mod] = h[mod], c[mod]
+                    continue
+                new_h[mod], new_c[mod] = self.lstm[mod](inputs[mod][i], (h[mod], c[mod]))
             # concatenate
-            prev_cs = []
-            new_cs = []
-            for mod in self.mods:
-                prev_cs.append(prev_c[mod])
-                new_cs.append(new_c[mod])
-            prev_cs = torch.cat(prev_cs, dim=1)
-            new_cs = torch.cat(new_cs, dim=1)
+            prev_cs = torch.cat([c[mod] for mod in self.mods], dim=1)
+            new_cs = torch.cat([new_c[mod] for mod in self.mods], dim=1)
             cStar = torch.cat([prev_cs,new_cs], dim=1)
             attention = F.softmax(self.att1_fc2(self.att1_dropout(F.relu(self.att1_fc1(cStar)))),dim=1)
             attended = attention*cStar
             cHat = F.tanh(self.att2_fc2(self.att2_dropout(F.relu(self.att2_fc1(attended)))))
-            both = torch.cat([attended,self.mem], dim=1)
+            both = torch.cat([attended,mem], dim=1)
             gamma1 = F.sigmoid(self.gamma1_fc2(self.gamma1_dropout(F.relu(self.gamma1_fc1(both)))))
             gamma2 = F.sigmoid(self.gamma2_fc2(self.gamma2_dropout(F.relu(self.gamma2_fc1(both)))))
-            self.mem = gamma1*self.mem + gamma2*cHat
-            all_mems.append(self.mem)
+            mem = gamma1*mem + gamma2*cHat
+            all_mems.append(mem)
             # update
+            h, c = new_h, new_c
             for mod in self.mods:
-                self.h[mod] = new_h[mod]
-                self.c[mod] = new_c[mod]
-                if mod not in all_hs.keys():
-                    all_hs[mod] = []
-                if mod not in all_cs.keys():
-                    all_cs[mod] = []
-                all_hs[mod].append(self.h[mod])
-                all_cs[mod].append(self.c[mod])
+                all_hs[mod].append(h[mod])
 
         # combining to get the output at each time step
-        outputs = []
-        for i in range(t):
-            last_hs = []
-            for mod in self.mods:
-                last_hs.append(all_hs[mod][i])
-            last_hs.append(all_mems[i])
-            last_hs = torch.cat(last_hs, dim=1)
-            output = self.out_fc2(self.out_dropout(F.relu(self.out_fc1(last_hs))))
-            outputs.append(output.unsqueeze(1))
-        outputs = torch.cat(outputs, dim=1)
-        return outputs
+        all_hs = torch.cat([torch.stack(all_hs[mod]) for mod in self.mods], dim=2)
+        outputs = self._output(all_hs, torch.stack(all_mems))
+        return outputs, MFNState([h[mod] for mod in self.mods],
+                                 [c[mod] for mod in self.mods], mem)
+
+# Worker threads of run_branches, created on first use
+_branch_pool = None
+_branch_pool_size = 0
+
+def _in_caller_context(fn):
+    """Wraps fn to run under the calling thread's grad mode and autocast
+    state, which are thread-local and do not reach pool threads."""
+    grad_enabled = torch.is_grad_enabled()
+    cpu_autocast = torch.is_autocast_cpu_enabled()
+    cpu_dtype = torch.get_autocast_cpu_dtype()
+    cuda_autocast = torch.is_autocast_enabled()
+    cuda_dtype = torch.get_autocast_gpu_dtype()
+    def wrapped(*args):
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+            if cpu_autocast:
+                stack.enter_context(torch.autocast('cpu', dtype=cpu_dtype))
+            if cuda_autocast:
+                stack.enter_context(torch.autocast('cuda', dtype=cuda_dtype))
+            return fn(*args)
+    return wrapped
+
+def run_branches(fn, mods, parallel=False):
+    """Returns {mod: fn(mod)} for every modality in mods.
+
+    With parallel set the modalities run concurrently, the first on the
+    calling thread and the others on a thread pool, and are joined before
+    returning. Operators release the GIL, so independent branches use
+    separate cores. Dropout draws from the shared generator in scheduling
+    order, so parallel training is not bit-for-bit reproducible.
+    """
+    # Tracing only records the calling thread
+    if not parallel or len(mods) < 2 or torch.jit.is_tracing():
+        return {mod: fn(mod) for mod in mods}
+    global _branch_pool, _branch_pool_size
+    if _branch_pool_size < len(mods) - 1:
+        if _branch_pool is not None:
+            _branch_pool.shutdown(wait=False)
+        _branch_pool = ThreadPoolExecutor(max_workers=len(mods) - 1)
+        _branch_pool_size = len(mods) - 1
+    futures = {mod: _branch_pool.submit(_in_caller_context(fn), mod)
+               for mod in mods[1:]}
+    outputs = {mods[0]: fn(mods[0])}
+    for mod in mods[1:]:
+        outputs[mod] = futures[mod].result()
+    return outputs
+
+def set_parallel(model, parallel=True):
+    """Runs the modality branches of every multimodal module in model
+    concurrently (see run_branches)."""
+    for module in model.modules():
+        if hasattr(module, 'parallel_branches'):
+            module.parallel_branches = parallel
 
 class MultiTransformer(nn.Module):
     def __init__(self, mods, window_embed_size,
@@ -279,11 +696,9 @@ class MultiTransformer(nn.Module):
         self.to(self.device)
 
     def forward(self, inputs, mask, lengths, tgt_init=0.5, target=None):
-        # Get batch dim
-        batch_size, seq_len = len(lengths), max(lengths)
         # Convert raw features into equal-dimensional embeddings
         mfn_in = dict()
-        for mod in self.mods:
+        for mod in present_mods(self.mods, inputs):
             # TODO: only linguistic cues will go through transformer
             #       otherwise just a linear layer
             embed = self.embed[mod](inputs[mod])
@@ -306,13 +721,64 @@ class MultiTransformer(nn.Module):
         # print(predicted)
         return predicted
 
+# Decoder state of UniTransformer and NLPTransformer: the previous LSTM
+# output and the (n_layers, n, embed_dim) LSTM hidden and cell states
+DecoderState = namedtuple('DecoderState', ['o_prev', 'h', 'c'])
+
+@torch.jit.script
+def _decoder_recurrence(gxs: torch.Tensor, o_prev: torch.Tensor,
+                        h: torch.Tensor, c: torch.Tensor, w_o: torch.Tensor,
+                        w_hh: torch.Tensor, b_hh: torch.Tensor):
+    """
+    Single-layer LSTM decoder fed its own previous output, compiled so the
+    loop runs without the interpreter. gxs holds the t x n x 4*hidden input
+    gates of the encoder outputs and w_o the input weights of the previous
+    output. After the first step the previous output is h, so w_o and w_hh
+    are folded into one recurrent weight. Returns the t x n x hidden outputs
+    and the final h and c.
+    """
+    t = gxs.size(0)
+    outputs = h.new_empty([t, h.size(0), h.size(1)])
+    w_fold = w_o + w_hh
+    for i in range(t):
+        if i == 0:
+            gates = gxs[i] + F.linear(o_prev, w_o) + F.linear(h, w_hh, b_hh)
+        else:
+            gates = gxs[i] + F.linear(h, w_fold, b_hh)
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+        c = torch.sigmoid(forgetgate)*c + torch.sigmoid(ingate)*torch.tanh(cellgate)
+        h = torch.sigmoid(outgate)*torch.tanh(c)
+        outputs[i] = h
+    return outputs, h, c
+
+def fused_decode(decoder, out, encoded, state):
+    """
+    Decodes n x t x embed_dim encoder outputs from state with the
+    single-layer LSTM decoder and out MLP of UniTransformer/NLPTransformer.
+    Projects the encoder half of the decoder inputs and applies out for all
+    timesteps at once, and runs the recurrence compiled. Returns the
+    n x t x 1 predictions and the final state, like a loop over step().
+    """
+    embed_dim = decoder.hidden_size
+    w_ih = decoder.weight_ih_l0
+    # Decoder inputs are [o_prev, encoded_t]
+    gxs = F.linear(encoded, w_ih[:, embed_dim:], decoder.bias_ih_l0).transpose(0, 1)
+    outputs, h, c = _decoder_recurrence(gxs, state.o_prev, state.h[0], state.c[0],
+                                        w_ih[:, :embed_dim], decoder.weight_hh_l0,
+                                        decoder.bias_hh_l0)
+    outputs = outputs.transpose(0, 1) # n, t, embed_dim
+    return out(outputs), DecoderState(outputs[:, -1], h.unsqueeze(0), c.unsqueeze(0))
+
 class UniTransformer(nn.Module):
     def __init__(self, window_embed_size, embed_dim=256, h_dim=128,
                  N=6, d_ff=128, h=8, dropout=0.1, n_layers=1,
+                 window=None, n_global=0, fused=True,
                  device=torch.device('cuda:0')):
         super(UniTransformer, self).__init__()
         self.embed_dim = embed_dim
         self.h_dim = h_dim
+        # Decode with fused_decode, see decode()
+        self.fused = fused
         # embedding layers
         # Create raw-to-embed FC+Dropout layer
         self.embed = nn.Linear(window_embed_size, embed_dim)
@@ -322,7 +788,7 @@ class UniTransformer(nn.Module):
         # encoder = encoder layer + sublayer connection
         # encoder layer = attention layer + feedforward + norm layer
         c = copy.deepcopy
-        attn = MultiHeadedAttention(h, embed_dim)
+        attn = MultiHeadedAttention(h, embed_dim, window=window, n_global=n_global)
         ff = PositionwiseFeedForward(embed_dim, d_ff, dropout)
         self.encoder = Encoder(EncoderLayer(embed_dim, c(attn), c(ff), dropout), N)
         # Decodes targets and LSTM hidden states
@@ -339,32 +805,51 @@ class UniTransformer(nn.Module):
                        torch.device('cpu'))
         self.to(self.device)
 
-    def forward(self, inputs, mask, lengths, tgt_init=0.5, target=None):
-        # Get batch dim
-        batch_size, seq_len = len(lengths), max(lengths)
-        # Convert raw features into equal-dimensional embeddings
-
-        embed = self.embed(inputs)
-        encoder_output = self.encoder(embed, mask) # batch_size, seq_len, self.embed_dim
-        # LSTM output from the encoder
-        # Set initial hidden and cell states for decoder
-        h0 = self.dec_h0.repeat(1, batch_size, 1)
-        c0 = self.dec_c0.repeat(1, batch_size, 1)
+    def init_state(self, batch_size):
+        """Initial decoder state for batch_size sequences."""
+        return DecoderState(torch.zeros(batch_size, self.embed_dim).to(self.device),
+                            self.dec_h0.repeat(1, batch_size, 1),
+                            self.dec_c0.repeat(1, batch_size, 1))
+
+    def encode(self, inputs, mask):
+        """Encoder outputs (batch_size, seq_len, embed_dim) of whole sequences,
+        since self-attention looks at every window of a sequence."""
+        return self.encoder(self.embed(inputs), mask)
+
+    def step(self, encoded_t, state):
+        """
+        Decodes one timestep of n x embed_dim encoder output, returns the
+        n x 1 prediction and the new state; the module itself holds no
+        state, so one model can serve many sequences.
+        """
+        # Concatenate prediction from previous timestep to context
+        i = torch.cat([state.o_prev, encoded_t], dim=1).unsqueeze(1)
+        # Get next decoder LSTM state and output
+        o, (h, c) = self.decoder(i, (state.h, state.c))
+        # Computer prediction from output state
+        p = self.out(o.view(-1, self.embed_dim))
+        return p, DecoderState(o.squeeze(1), h, c)
+
+    def decode(self, encoded, state):
+        """
+        Decodes n x t x embed_dim encoder outputs from state, returns the
+        n x t x 1 predictions and the final state. Uses fused_decode unless
+        fused is off, the decoder is stacked or quantized, or autocast is
+        active.
+        """
+        if self.fused and self.decoder.num_layers == 1 and not _autocast_enabled() \
+           and _float_weights(self.decoder):
+            return fused_decode(self.decoder, self.out, encoded, state)
         predicted = []
-        # p = torch.ones(batch_size, 1).to(self.device) * tgt_init
-        o_prev = torch.zeros(batch_size, self.embed_dim).to(self.device)
-        h, c = h0, c0
-        for t in range(seq_len):
-            # Concatenate prediction from previous timestep to context
-            i = torch.cat([o_prev, encoder_output[:,t,:]], dim=1).unsqueeze(1)
-            # Get next decoder LSTM state and output
-            o, (h, c) = self.decoder(i, (h, c))
-            o_prev = o.squeeze(1)
-            # Computer prediction from output state
-            p = self.out(o.view(-1, self.embed_dim))
+        for t in range(encoded.size(1)):
+            p, state = self.step(encoded[:,t,:], state)
             predicted.append(p.unsqueeze(1))
-            # print(predicted)
-        predicted = torch.cat(predicted, dim=1)
+        return torch.cat(predicted, dim=1), state
+
+    def forward(self, inputs, mask, lengths, tgt_init=0.5, target=None):
+        encoder_output = self.encode(inputs, mask) # batch_size, seq_len, self.embed_dim
+        # LSTM output from the encoder
+        predicted, _ = self.decode(encoder_output, self.init_state(encoder_output.size(0)))
         # Mask target entries that exceed sequence lengths
         predicted = predicted * mask.float()
         return predicted
@@ -372,6 +857,7 @@ class UniTransformer(nn.Module):
 class UniFullTransformer(nn.Module):
     def __init__(self, window_embed_size, embed_dim=256, h_dim=128,
                  N=6, d_ff=128, h=8, dropout=0.1, n_layers=1,
+                 window=None, n_global=0,
                  device=torch.device('cuda:0')):
         super(UniFullTransformer, self).__init__()
         self.embed_dim = embed_dim
@@ -385,7 +871,7 @@ class UniFullTransformer(nn.Module):
         # encoder = encoder layer + sublayer connection
         # encoder layer = attention layer + feedforward + norm layer
         c = copy.deepcopy
-        attn = MultiHeadedAttention(h, embed_dim)
+        attn = MultiHeadedAttention(h, embed_dim, window=window, n_global=n_global)
         ff = PositionwiseFeedForward(embed_dim, d_ff, dropout)
         self.encoder = Encoder(EncoderLayer(embed_dim, c(attn), c(ff), dropout), N)
 
@@ -400,8 +886,6 @@ class UniFullTransformer(nn.Module):
         self.to(self.device)
 
     def forward(self, inputs, mask, lengths, tgt_init=0.5, target=None):
-        # Get batch dim
-        batch_size, seq_len = len(lengths), max(lengths)
         # Convert raw features into equal-dimensional embeddings
 
         embed = self.embed(inputs)
@@ -0,0 +1,203 @@
+"""Distils a trained MFT checkpoint into a compact MultiCNNStudent."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os, time
+import argparse
+import copy
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.optim.lr_scheduler import ReduceLROnPlateau
+
+from datasets import load_dataset
+from models import MultiCNNTransformer, MultiCNNStudent
+from multiTransformer import apply_structure
+from featureReduction import apply_reduction
+import train
+from train import generateTrainBatch, evaluate, constructInput, padInput, padRating, \
+    save_checkpoint, load_checkpoint, logger
+
+def load_teacher(path, device):
+    """MultiCNNTransformer saved by train.save_checkpoint or prune.py, its
+    checkpoint and its window embedding sizes."""
+    checkpoint = load_checkpoint(path, device)
+    state = checkpoint['model']
+    # Window embedding sizes are the CNN output channels
+    embed_dims = {mod: state['cnn_{}.conv1d.weight'.format(mod)].shape[0]
+                  for mod in checkpoint['modalities']}
+    model = MultiCNNTransformer(mods=checkpoint['modalities'],
+                                dims=checkpoint['mod_dimension'],
+                                embed_dims=embed_dims, device=device)
+    if 'structure' in checkpoint:
+        # Pruned encoders (prune.py)
+        apply_structure(model, checkpoint['structure'])
+    model.load_state_dict(state)
+    return model, checkpoint, embed_dims
+
+def load_split(checkpoint, split, args):
+    """Windowed and padded (inputs, ratings, lengths) of split for the
+    model of checkpoint, as in train.main."""
+    mods = checkpoint['modalities']
+    data = load_dataset(mods, args.data_dir, split, base_rate=args.base_rate,
+                        truncate=True, item_as_dict=True)
+    if 'reduction' in checkpoint:
+        # Image features projected as for training (--reduce_image)
+        apply_reduction(checkpoint['reduction'], data)
+    features, ratings = constructInput(data, channels=mods,
+                                       window_size=checkpoint['window_size'])
+    padded, seq_lens = padInput(features, mods, checkpoint['mod_dimension'])
+    return padded, padRating(ratings, max(seq_lens)), seq_lens
+
+def soft_targets(teacher, input_data, ratings, lengths, alpha, args):
+    """
+    Padded per-window training targets alpha * rating + (1 - alpha) *
+    teacher prediction. The squared error to this blend equals the alpha
+    weighted sum of the squared errors to the ratings and to the teacher,
+    up to a constant, so train.train() fits both without changes.
+    """
+    teacher.eval()
+    targets = []
+    with torch.no_grad():
+        # batch_size=1 and onEval keep the sequences in order
+        for i, (data, _, mask, batch_lengths) in enumerate(
+                generateTrainBatch(input_data, ratings, lengths, args,
+                                   batch_size=1, onEval=True)):
+            for mod in list(data.keys()):
+                data[mod] = data[mod].to(args.device)
+            output = teacher(data, batch_lengths, mask.to(args.device))
+            soft = output[0, :lengths[i], 0].float().cpu().numpy()
+            targets.append((alpha * np.asarray(ratings[i][:lengths[i]])
+                            + (1 - alpha) * soft).tolist())
+    return padRating(targets, max(lengths))
+
+def count_parameters(model):
+    return sum(p.numel() for p in model.parameters())
+
+def scoring_speed(model, input_data, ratings, lengths, args, threads=1):
+    """Windows scored per second, one sequence at a time on threads intra-op
+    threads (on --device cpu, single core by default)."""
+    model.eval()
+    num_threads = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    start = time.time()
+    with torch.no_grad():
+        for (data, _, mask, batch_lengths) in generateTrainBatch(
+                input_data, ratings, lengths, args, batch_size=1, onEval=True):
+            for mod in list(data.keys()):
+                data[mod] = data[mod].to(args.device)
+            model(data, batch_lengths, mask.to(args.device))
+    elapsed = time.time() - start
+    torch.set_num_threads(num_threads)
+    return sum(lengths) / elapsed
+
+def main(args):
+    # Fix random seed
+    torch.manual_seed(1)
+    torch.cuda.manual_seed(1)
+    np.random.seed(1)
+    # Convert device string to torch.device
+    args.device = (torch.device(args.device) if torch.cuda.is_available()
+                   else torch.device('cpu'))
+    criterion = nn.MSELoss(reduction='sum')
+
+    teacher, checkpoint, embed_dims = load_teacher(args.teacher, args.device)
+    mods = checkpoint['modalities']
+    mod_dimension = checkpoint['mod_dimension']
+    window_size = checkpoint['window_size']
+    print("Loading data...")
+    input_train, ratings_train, lens_train = load_split(checkpoint, 'Train', args)
+    input_test, ratings_test, lens_test = load_split(checkpoint, 'Valid', args)
+    print("Done.")
+    targets_train = soft_targets(teacher, input_train, ratings_train,
+                                 lens_train, args.alpha, args)
+
+    student = MultiCNNStudent(mods=mods, dims=mod_dimension, embed_dims=embed_dims,
+                              embed_dim=args.embed_dim, h_dim=args.h_dim,
+                              N=args.n_layers, device=args.device)
+    if args.init_windows:
+        # Start from the teacher's window encoders
+        state = {k: v for k, v in teacher.state_dict().items()
+                 if k.startswith(('cnn_', 'highway_'))}
+        student.load_state_dict(state, strict=False)
+    optimizer = optim.Adam(student.parameters(), lr=args.lr, weight_decay=1e-4)
+    scheduler = ReduceLROnPlateau(optimizer, mode='min', patience=100, factor=0.5)
+
+    best_ccc, best_state = -1, None
+    for epoch in range(1, args.epochs+1):
+        print('---')
+        train.train(input_train, targets_train, lens_train, student, criterion,
+                    optimizer, epoch, args)
+        if epoch % args.eval_freq == 0:
+            with torch.no_grad():
+                _, loss, stats, _ = evaluate(input_test, ratings_test, lens_test,
+                                             student, criterion, args)
+            scheduler.step(loss)
+            if stats['ccc'] > best_ccc:
+                best_ccc = stats['ccc']
+                best_state = copy.deepcopy(student.state_dict())
+                save_checkpoint(mods, mod_dimension, window_size, student, args.save,
+                                reduction=checkpoint.get('reduction'))
+    if best_state is not None:
+        student.load_state_dict(best_state)
+
+    # Teacher versus student on the Valid set
+    logger.info('model\tparams\tValid CCC\twindows/s\tx real time')
+    for name, model in [('teacher', teacher), ('student', student)]:
+        with torch.no_grad():
+            _, _, stats, _ = evaluate(input_test, ratings_test, lens_test,
+                                      model, criterion, args)
+        speed = scoring_speed(model, input_test, ratings_test, lens_test,
+                              args, args.threads)
+        # Each window covers window_size['ratings'] seconds
+        logger.info('{}\t{}\t{:0.5f}\t{:.1f}\t{:.1f}'.format(
+            name, count_parameters(model), stats['ccc'], speed,
+            speed * window_size['ratings']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--teacher', type=str, default="../ModelSave/MFT/MFT-VAL-88.pth",
+                        help='MFT checkpoint to distil (default: ../ModelSave/MFT/MFT-VAL-88.pth)')
+    parser.add_argument('--save', type=str, default=None,
+                        help='student checkpoint path (default: <teacher>-student.pth)')
+    parser.add_argument('--alpha', type=float, default=0.5, metavar='F',
+                        help='weight of the ratings against the teacher (default: 0.5)')
+    parser.add_argument('--embed_dim', type=int, default=64, metavar='N',
+                        help='student fused embedding size (default: 64)')
+    parser.add_argument('--h_dim', type=int, default=64, metavar='N',
+                        help='student GRU hidden size (default: 64)')
+    parser.add_argument('--n_layers', type=int, default=1, metavar='N',
+                        help='student encoder layers (default: 1)')
+    parser.add_argument('--init_windows', action='store_true', default=False,
+                        help="start from the teacher's window encoders (default: false)")
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='intra-op threads when timing scoring (default: 1)')
+    parser.add_argument('--epochs', type=int, default=200, metavar='N',
+                        help='number of epochs to train (default: 200)')
+    parser.add_argument('--lr', type=float, default=1e-3, metavar='LR',
+                        help='learning rate (default: 1e-3)')
+    parser.add_argument('--base_rate', type=float, default=2.0, metavar='N',
+                        help='sampling rate to resample to (default: 2.0)')
+    parser.add_argument('--log_freq', type=int, default=5, metavar='N',
+                        help='print loss N times every epoch (default: 5)')
+    parser.add_argument('--eval_freq', type=int, default=1, metavar='N',
+                        help='evaluate every N epochs (default: 1)')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='bfloat16 autocast for training and inference (default: false)')
+    parser.add_argument('--log_memory', action='store_true', default=False,
+                        help='also log live tensor counts every epoch (default: false)')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device to use (default: cpu)')
+    parser.add_argument('--data_dir', type=str, default="../../../SENDv1-data",
+                        help='path to data base directory')
+    args = parser.parse_args()
+    if args.save is None:
+        args.save = os.path.splitext(args.teacher)[0] + '-student.pth'
+    train.logFilename = "./distill.log"
+    train.setup_logging()
+    main(args)
@@ -0,0 +1,198 @@
+"""Prunes attention heads and encoder layers of a trained MFT checkpoint."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import argparse
+import copy
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from multiTransformer import Encoder, encoder_structure
+import train
+from train import generateTrainBatch, evaluate, logger
+from distill import load_teacher, load_split, count_parameters, scoring_speed
+
+def encoders(model):
+    return {name: module for name, module in model.named_modules()
+            if isinstance(module, Encoder)}
+
+def head_importance(model, input_data, ratings, lengths, criterion, args):
+    """
+    Importance of every head, by Encoder name and layer: the absolute
+    gradient of the loss over the sequences with respect to a scale on the
+    head's output (Michel et al., 2019), normalized within each layer.
+    """
+    gates = {name: [] for name in encoders(model)}
+    for name, encoder in encoders(model).items():
+        for layer in encoder.layers:
+            layer.self_attn.head_gate = torch.ones(layer.self_attn.h, device=args.device,
+                                                   requires_grad=True)
+            gates[name].append(layer.self_attn.head_gate)
+    scores = {name: [torch.zeros_like(g) for g in gs] for name, gs in gates.items()}
+    model.eval()
+    for (data, target, mask, batch_lengths) in generateTrainBatch(
+            input_data, ratings, lengths, args, batch_size=1, onEval=True):
+        for mod in list(data.keys()):
+            data[mod] = data[mod].to(args.device)
+        loss = criterion(model(data, batch_lengths, mask.to(args.device)),
+                         target.to(args.device))
+        all_gates = [g for name in gates for g in gates[name]]
+        grads = iter(torch.autograd.grad(loss, all_gates))
+        for name in gates:
+            for score in scores[name]:
+                score += next(grads).abs()
+    for name, encoder in encoders(model).items():
+        for layer in encoder.layers:
+            layer.self_attn.head_gate = None
+    return {name: [(s / s.norm()).cpu().numpy() for s in layer_scores]
+            for name, layer_scores in scores.items()}
+
+def layer_importance(model, eval_set, criterion, args):
+    """Valid CCC lost by skipping each layer, by Encoder name."""
+    with torch.no_grad():
+        _, _, stats, _ = evaluate(*eval_set, model, criterion, args)
+    scores = {}
+    for name, encoder in encoders(model).items():
+        layers = encoder.layers
+        scores[name] = []
+        for i in range(len(layers)):
+            encoder.layers = nn.ModuleList([l for j, l in enumerate(layers) if j != i])
+            with torch.no_grad():
+                _, _, skipped, _ = evaluate(*eval_set, model, criterion, args)
+            scores[name].append(stats['ccc'] - skipped['ccc'])
+        encoder.layers = layers
+    return scores
+
+def prune(model, head_scores, layer_scores, head_fraction, layers_removed):
+    """
+    Copy of model without the layers_removed least important layers of
+    every Encoder (keeping at least one), then without head_fraction of the
+    remaining heads, least important first and at least one per layer.
+    """
+    model = copy.deepcopy(model)
+    keep_layers, heads = {}, []
+    for name, encoder in encoders(model).items():
+        order = np.argsort(layer_scores[name])
+        keep_layers[name] = [int(i) for i in order[min(layers_removed, len(order) - 1):]]
+        for i in keep_layers[name]:
+            heads += [(score, name, i, head) for head, score in enumerate(head_scores[name][i])]
+    keep_heads = {(name, i): set(range(len(head_scores[name][i])))
+                  for name in keep_layers for i in keep_layers[name]}
+    budget = int(head_fraction * len(heads))
+    for _, name, i, head in sorted(heads):
+        if budget == 0:
+            break
+        if len(keep_heads[(name, i)]) > 1:
+            keep_heads[(name, i)].discard(head)
+            budget -= 1
+    for name, encoder in encoders(model).items():
+        for i in keep_layers[name]:
+            attn = encoder.layers[i].self_attn
+            if len(keep_heads[(name, i)]) < attn.h:
+                attn.prune_heads(keep_heads[(name, i)])
+        encoder.prune_layers(keep_layers[name])
+    return model
+
+def save_pruned(checkpoint, model, path):
+    """Saves model like its original checkpoint, plus the encoder structure
+    that apply_structure() restores before loading."""
+    pruned = dict(checkpoint, model=model.state_dict(),
+                  structure=encoder_structure(model))
+    torch.save(pruned, path)
+
+def fine_tune(model, train_set, eval_set, criterion, args):
+    """Trains model for args.epochs, keeping the weights of its best Valid
+    CCC; returns that CCC."""
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
+    best_ccc, best_state = -1, None
+    for epoch in range(1, args.epochs+1):
+        train.train(*train_set, model, criterion, optimizer, epoch, args)
+        with torch.no_grad():
+            _, _, stats, _ = evaluate(*eval_set, model, criterion, args)
+        if stats['ccc'] > best_ccc:
+            best_ccc, best_state = stats['ccc'], copy.deepcopy(model.state_dict())
+    if best_state is not None:
+        model.load_state_dict(best_state)
+    return best_ccc
+
+def main(args):
+    # Fix random seed
+    torch.manual_seed(1)
+    torch.cuda.manual_seed(1)
+    np.random.seed(1)
+    # Convert device string to torch.device
+    args.device = (torch.device(args.device) if torch.cuda.is_available()
+                   else torch.device('cpu'))
+    criterion = nn.MSELoss(reduction='sum')
+
+    model, checkpoint, _ = load_teacher(args.load, args.device)
+    print("Loading data...")
+    train_set = load_split(checkpoint, 'Train', args)
+    eval_set = load_split(checkpoint, 'Valid', args)
+    print("Done.")
+    head_scores = head_importance(model, *eval_set, criterion, args)
+    layer_scores = layer_importance(model, eval_set, criterion, args)
+    for name in sorted(head_scores):
+        logger.info('{}\tlayer CCC loss: {}'.format(
+            name, ' '.join('{:+0.4f}'.format(s) for s in layer_scores[name])))
+
+    with torch.no_grad():
+        _, _, stats, _ = evaluate(*eval_set, model, criterion, args)
+    rows = [('original', count_parameters(model), stats['ccc'],
+             scoring_speed(model, *eval_set, args, args.threads))]
+    base = os.path.splitext(args.load)[0]
+    for fraction in args.head_fractions:
+        for removed in args.layers_removed:
+            if fraction == 0 and removed == 0:
+                continue
+            pruned = prune(model, head_scores, layer_scores, fraction, removed)
+            ccc = fine_tune(pruned, train_set, eval_set, criterion, args)
+            path = '{}-prune-h{}-l{}.pth'.format(base, int(round(100 * fraction)), removed)
+            save_pruned(checkpoint, pruned, path)
+            rows.append((os.path.basename(path), count_parameters(pruned), ccc,
+                         scoring_speed(pruned, *eval_set, args, args.threads)))
+
+    # Pareto front: no other model is both faster and more accurate
+    logger.info('model\tparams\tValid CCC\tms/window\tpareto')
+    for row in rows:
+        dominated = any(o[2] >= row[2] and o[3] >= row[3] and o != row for o in rows)
+        logger.info('{}\t{}\t{:0.5f}\t{:.3f}\t{}'.format(
+            row[0], row[1], row[2], 1000.0 / row[3], '' if dominated else '*'))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load', type=str, default="../ModelSave/MFT/MFT-VAL-88.pth",
+                        help='MFT checkpoint to prune (default: ../ModelSave/MFT/MFT-VAL-88.pth)')
+    parser.add_argument('--head_fractions', type=float, nargs='+', default=[0.0, 0.25, 0.5],
+                        help='fractions of the heads to remove (default: 0 0.25 0.5)')
+    parser.add_argument('--layers_removed', type=int, nargs='+', default=[0, 2],
+                        help='layers to remove from every encoder (default: 0 2)')
+    parser.add_argument('--threads', type=int, default=1, metavar='N',
+                        help='intra-op threads when timing scoring (default: 1)')
+    parser.add_argument('--epochs', type=int, default=10, metavar='N',
+                        help='fine-tuning epochs per pruned model (default: 10)')
+    parser.add_argument('--lr', type=float, default=1e-4, metavar='LR',
+                        help='fine-tuning learning rate (default: 1e-4)')
+    parser.add_argument('--base_rate', type=float, default=2.0, metavar='N',
+                        help='sampling rate to resample to (default: 2.0)')
+    parser.add_argument('--log_freq', type=int, default=5, metavar='N',
+                        help='print loss N times every epoch (default: 5)')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='bfloat16 autocast for training and inference (default: false)')
+    parser.add_argument('--log_memory', action='store_true', default=False,
+                        help='also log live tensor counts every epoch (default: false)')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device to use (default: cpu)')
+    parser.add_argument('--data_dir', type=str, default="../../../SENDv1-data",
+                        help='path to data base directory')
+    args = parser.parse_args()
+    train.logFilename = "./prune.log"
+    train.setup_logging()
+    main(args)
@@ -0,0 +1,943 @@
+"""Speed benchmarks for the model variants on synthetic inputs.
+
+Models are imported from the variant directory given by --variant, e.g.
+    python benchmark.py --variant MFT --bench ddp
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys, os, time
+import argparse
+
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.multiprocessing as mp
+
+# Raw feature dimensions (B1-LSTM uses BERT linguistic features)
+mod_dimension = {'linguistic' : 300, 'emotient' : 20, 'acoustic' : 88, 'image' : 1000}
+window_embed_size = {'linguistic' : 300, 'emotient' : 20, 'acoustic' : 88, 'image' : 256}
+
+def add_variant_path(variant):
+    """Puts the variant's models ahead of this directory's copies."""
+    variant_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               '..', variant)
+    sys.path.insert(0, os.path.abspath(variant_dir))
+
+def variant_dims(variant):
+    dims = dict(mod_dimension)
+    if variant == 'B1-LSTM':
+        dims['linguistic'] = 1024
+    return dims
+
+def build_model(variant, mods, dims=None, embed_dims=None,
+                device=torch.device('cpu')):
+    """Constructs the variant's top-level model as its train.py does."""
+    import models
+    if dims is None:
+        dims = variant_dims(variant)
+    if variant == 'B1-LSTM':
+        return models.MultiCNNLSTM(mods=mods, dims=dims, device=device)
+    if variant in ('MFT', 'Performance-Eval'):
+        if embed_dims is None:
+            embed_dims = window_embed_size
+        return models.MultiCNNTransformer(mods=mods, dims=dims,
+                                          embed_dims=embed_dims,
+                                          device=device)
+    return models.MultiCNNTransformer(mods=mods, dims=dims, device=device)
+
+def load_model(variant, path, device=torch.device('cpu')):
+    """Rebuilds a model saved by train.save_checkpoint."""
+    checkpoint = torch.load(path, map_location=device)
+    state = checkpoint['model']
+    # Window embedding sizes are the CNN output channels
+    embed_dims = dict(window_embed_size)
+    for mod in checkpoint['modalities']:
+        embed_dims[mod] = state['cnn_{}.conv1d.weight'.format(mod)].shape[0]
+    model = build_model(variant, checkpoint['modalities'],
+                        checkpoint['mod_dimension'], embed_dims, device)
+    if 'structure' in checkpoint:
+        # Pruned encoders (prune.py)
+        from multiTransformer import apply_structure
+        apply_structure(model, checkpoint['structure'])
+    model.load_state_dict(state)
+    return model, checkpoint
+
+def load_eval_set(checkpoint, data_dir, subset='Valid'):
+    """Windowed and padded (inputs, ratings, lengths) as in train.main."""
+    from datasets import load_dataset
+    import train
+    mods = checkpoint['modalities']
+    window_size = checkpoint['window_size']
+    eval_data = load_dataset(mods, data_dir, subset, truncate=True,
+                             item_as_dict=True)
+    if 'reduction' in checkpoint:
+        # Image features projected as for training (--reduce_image)
+        from featureReduction import apply_reduction
+        apply_reduction(checkpoint['reduction'], eval_data)
+    features, ratings = train.constructInput(eval_data, channels=mods,
+                                             window_size=window_size)
+    padded, seq_lens = train.padInput(features, mods,
+                                      checkpoint['mod_dimension'])
+    return padded, train.padRating(ratings, max(seq_lens)), seq_lens
+
+def make_batch(variant, mods, batch_size, seq_len, frames, dims=None):
+    """Random batch shaped like generateTrainBatch output."""
+    if dims is None:
+        dims = variant_dims(variant)
+    data = {mod: torch.randn(batch_size, seq_len, frames, dims[mod])
+            for mod in mods}
+    target = torch.rand(batch_size, seq_len, 1)
+    # Sequence lengths sorted from long to short as in generateTrainBatch
+    lengths = sorted([max(1, seq_len - 7*i) for i in range(batch_size)],
+                     reverse=True)
+    mask = torch.zeros(batch_size, seq_len, 1)
+    for i, l in enumerate(lengths):
+        mask[i,:l] = 1
+    return data, target, mask, lengths
+
+def make_sequences(variant, mods, num, seq_len, frames):
+    """Random nested-list inputs as padInput/padRating produce them."""
+    dims = variant_dims(variant)
+    data = {mod: np.random.randn(num, seq_len, frames, dims[mod])
+                   .astype(np.float32).tolist() for mod in mods}
+    ratings = np.random.rand(num, seq_len).tolist()
+    return data, ratings, [seq_len] * num
+
+def time_steps(step, steps, warmup=1):
+    """Seconds per call of step() after warmup calls."""
+    for _ in range(warmup):
+        step()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    return (time.time() - start) / steps
+
+def _ddp_worker(rank, world_size, args, results):
+    import ddp
+    ddp.init_process(rank, world_size, args.master_port)
+    torch.manual_seed(1)
+    model = build_model(args.variant, args.modalities)
+    train_model = ddp.wrap(model)
+    criterion = nn.MSELoss(reduction='sum')
+    optimizer = optim.Adam(model.parameters(), lr=1e-4)
+    data, target, mask, lengths = make_batch(args.variant, args.modalities,
+                                             args.batch_size, args.seq_len,
+                                             args.frames)
+    def step():
+        output = train_model(data, lengths, mask)
+        loss = criterion(output, target) / sum(lengths)
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+    elapsed = time_steps(step, args.steps)
+    if ddp.is_master():
+        results.put(elapsed)
+    ddp.cleanup()
+
+def bench_ddp(args):
+    """Data-parallel training throughput for 1/2/4/8 gloo processes.
+
+    Every process trains on its own batch with cpu_count/N threads, so
+    efficiency = speed(N) / (N * speed(1)) at a fixed core budget.
+    """
+    ctx = mp.get_context('spawn')
+    base = None
+    print("procs\tsteps/s\tspeedup\tefficiency")
+    for world_size in args.world_sizes:
+        results = ctx.SimpleQueue()
+        mp.start_processes(_ddp_worker, args=(world_size, args, results),
+                           nprocs=world_size, start_method='spawn')
+        elapsed = results.get()
+        speed = world_size * args.batch_size * args.seq_len / elapsed
+        if base is None:
+            base = speed / world_size
+        print("{}\t{:.1f}\t{:.2f}\t{:.2f}".format(
+            world_size, speed, speed / base, speed / (base * world_size)))
+
+def bench_bf16(args):
+    """Float32 vs bfloat16 autocast throughput (and Valid CCC with --load)."""
+    torch.manual_seed(1)
+    device = torch.device('cpu')
+    if args.load is not None:
+        model, checkpoint = load_model(args.variant, args.load, device)
+    else:
+        model = build_model(args.variant, args.modalities)
+    mods = model.mods
+    criterion = nn.MSELoss(reduction='sum')
+    optimizer = optim.SGD(model.parameters(), lr=0.0)
+    # Loaded models may take projected image features (--reduce_image)
+    data, target, mask, lengths = make_batch(args.variant, mods,
+                                             args.batch_size, args.seq_len,
+                                             args.frames, model.dims)
+    timesteps = sum(lengths)
+    outputs = {}
+    print("mode\ttrain steps/s\tinfer steps/s")
+    for name, enabled in [('fp32', False), ('bf16', True)]:
+        def train_step():
+            model.train()
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled):
+                output = model(data, lengths, mask)
+            loss = criterion(output.float(), target)
+            loss.backward()
+            optimizer.zero_grad()
+        def infer_step():
+            model.eval()
+            with torch.no_grad(), \
+                 torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled):
+                outputs[name] = model(data, lengths, mask).float()
+        train_time = time_steps(train_step, args.steps)
+        infer_time = time_steps(infer_step, args.steps)
+        print("{}\t{:.1f}\t{:.1f}".format(name, timesteps / train_time,
+                                          timesteps / infer_time))
+    print("max |bf16 - fp32| prediction: {:.2e}".format(
+        (outputs['bf16'] - outputs['fp32']).abs().max().item()))
+    if args.load is None or args.data_dir is None:
+        return
+    import train
+    eval_set = load_eval_set(checkpoint, args.data_dir)
+    eval_args = argparse.Namespace(device=device, bf16=False)
+    ccc = {}
+    for name, enabled in [('fp32', False), ('bf16', True)]:
+        eval_args.bf16 = enabled
+        with torch.no_grad():
+            _, _, stats, _ = train.evaluate(*eval_set, model, criterion,
+                                            eval_args)
+        ccc[name] = stats['ccc']
+    print("Valid CCC\tfp32: {:0.5f}\tbf16: {:0.5f}\tdelta: {:+0.5f}".format(
+        ccc['fp32'], ccc['bf16'], ccc['bf16'] - ccc['fp32']))
+
+def bench_memory(args):
+    """Regression check: peak RSS of train() must not grow with epoch length.
+
+    Trains one epoch on --mem_batches batches and one on four times as
+    many. The same pair is then run with a criterion whose losses are kept
+    until the end of the epoch, as a running loss tensor would keep them;
+    the check exits with status 1 if the real growth exceeds
+    --mem_tolerance of that leaked growth, and with status 2 if the leak
+    is under --mem_floor MB (raise --seq_len or --frames then). The
+    inputs are nested lists, so keep them small, e.g.
+        --modalities acoustic --seq_len 20 --frames 5
+    """
+    import train, memoryStats
+    torch.manual_seed(1)
+    np.random.seed(1)
+    model = build_model(args.variant, args.modalities)
+    criterion = nn.MSELoss(reduction='sum')
+    optimizer = optim.SGD(model.parameters(), lr=0.0)
+    train_args = argparse.Namespace(device=torch.device('cpu'), bf16=False,
+                                    log_memory=False, log_freq=5)
+    # generateTrainBatch yields batches of 25 sequences; all inputs are
+    # built up front so the epochs only differ in the number of batches
+    num = 25 * 4 * args.mem_batches
+    data, ratings, lengths = make_sequences(args.variant, args.modalities,
+                                            num, args.seq_len, args.frames)
+    kept = []
+    def leaky(output, target):
+        kept.append(criterion(output, target))
+        return kept[-1]
+    def epoch(n, loss_fn=criterion):
+        # Start every epoch from the same resident heap
+        memoryStats.trim()
+        subset = {mod: data[mod][:n] for mod in data}
+        train.train(subset, ratings[:n], lengths[:n], model, loss_fn,
+                    optimizer, 0, train_args)
+        peak = memoryStats.peak_rss()
+        del kept[:]
+        return peak
+    # Warm up allocator and thread pools before measuring
+    epoch(num // 4)
+    short_peak = epoch(num // 4)
+    growth = epoch(num) - short_peak
+    short_peak = epoch(num // 4, leaky)
+    leak = epoch(num, leaky) - short_peak
+    print("peak RSS growth over {} extra batches\ttrain(): {:+.1f} MB\t"
+          "losses kept: {:+.1f} MB".format(3 * args.mem_batches, growth, leak))
+    if leak < args.mem_floor:
+        print("inputs too small to detect a leak (< {:.0f} MB)".format(args.mem_floor))
+        sys.exit(2)
+    if growth > args.mem_tolerance * leak:
+        print("FAIL: peak memory grows with the number of batches")
+        sys.exit(1)
+    print("OK")
+
+def bench_mfn(args):
+    """Per-step latency of the MFN recurrence: interpreted loop, scripted,
+    and scripted with the block-diagonal cell."""
+    from multiTransformer import MFN
+    torch.manual_seed(1)
+    embed_dim = {'linguistic' : 256, 'emotient' : 16, 'acoustic' : 256, 'image' : 256}
+    mfn = {name: MFN(args.modalities, embed_dim, 1, fused=fused,
+                     block_diag=block_diag, device=torch.device('cpu'))
+           for name, fused, block_diag in [('loop', False, False),
+                                           ('fused', True, False),
+                                           ('block', True, True)]}
+    # All variants share one set of weights
+    for name in ['fused', 'block']:
+        mfn[name].load_state_dict(mfn['loop'].state_dict())
+    inputs = {mod: torch.randn(args.seq_len, args.batch_size, embed_dim[mod])
+              for mod in args.modalities}
+    outputs = {}
+    print("mode	train us/step	infer us/step")
+    for name, model in mfn.items():
+        def train_step():
+            model.train()
+            model(inputs).sum().backward()
+            model.zero_grad()
+        def infer_step():
+            model.eval()
+            with torch.no_grad():
+                outputs[name] = model(inputs)
+        # Scripted functions are optimized over the first calls
+        train_time = time_steps(train_step, args.steps, warmup=3)
+        infer_time = time_steps(infer_step, args.steps, warmup=3)
+        print("{}\t{:.1f}\t{:.1f}".format(name, 1e6 * train_time / args.seq_len,
+                                          1e6 * infer_time / args.seq_len))
+    for name in ['fused', 'block']:
+        print("max |{} - loop| prediction: {:.2e}".format(
+            name, (outputs[name] - outputs['loop']).abs().max().item()))
+
+def bench_stream(args):
+    """Per-step latency of MFN.step and its agreement with forward()."""
+    from multiTransformer import MFN
+    torch.manual_seed(1)
+    embed_dim = {'linguistic' : 256, 'emotient' : 16, 'acoustic' : 256, 'image' : 256}
+    model = MFN(args.modalities, embed_dim, 1, device=torch.device('cpu'))
+    model.eval()
+    inputs = {mod: torch.randn(args.seq_len, args.batch_size, embed_dim[mod])
+              for mod in args.modalities}
+    with torch.no_grad():
+        full = model(inputs)
+        streamed = []
+        state = model.init_state(args.batch_size)
+        start = time.time()
+        for t in range(args.seq_len):
+            pred, state = model.step({mod: inputs[mod][t] for mod in args.modalities},
+                                     state)
+            streamed.append(pred)
+        elapsed = time.time() - start
+    streamed = torch.stack(streamed, dim=1)
+    print("step: {:.1f} us/step for {} sequences".format(
+        1e6 * elapsed / args.seq_len, args.batch_size))
+    print("max |step - forward| prediction: {:.2e}".format(
+        (streamed - full).abs().max().item()))
+
+def bench_arscan(args):
+    """MultiARLSTM inference, sequential AR loop vs parallel scan."""
+    from models import MultiARLSTM
+    torch.manual_seed(1)
+    window_embed_size = 88
+    model = {name: MultiARLSTM(window_embed_size, ar_order=args.ar_order,
+                               scan=scan, device=torch.device('cpu'))
+             for name, scan in [('loop', False), ('scan', True)]}
+    model['scan'].load_state_dict(model['loop'].state_dict())
+    inputs = torch.randn(args.batch_size, args.seq_len, window_embed_size)
+    lengths = [args.seq_len] * args.batch_size
+    mask = torch.ones(args.batch_size, args.seq_len, 1)
+    outputs = {}
+    print("mode\tinfer steps/s")
+    for name in ['loop', 'scan']:
+        model[name].eval()
+        def infer_step():
+            with torch.no_grad():
+                outputs[name] = model[name](inputs, mask, lengths)
+        infer_time = time_steps(infer_step, args.steps)
+        print("{}\t{:.1f}".format(name, sum(lengths) / infer_time))
+    print("max |scan - loop| prediction: {:.2e}".format(
+        (outputs['scan'] - outputs['loop']).abs().max().item()))
+
+def bench_convolve(args):
+    """models.convolve against the shifted-copies version it replaced."""
+    from models import convolve, pad_shift
+    def convolve_shifted(x, attn):
+        stacked = torch.stack([pad_shift(x, i) for
+                               i in range(attn.shape[2])], dim=-1)
+        return torch.sum(attn.unsqueeze(2) * stacked, dim=-1)
+    torch.manual_seed(1)
+    x = torch.randn(args.batch_size, args.seq_len, args.h_dim)
+    print("attn_len\tshifted ms\tunfold ms\tmax diff")
+    for attn_len in [3, 5, 7]:
+        attn = torch.softmax(torch.randn(args.batch_size, args.seq_len, attn_len), dim=-1)
+        outputs = {}
+        times = {}
+        for name, fn in [('shifted', convolve_shifted), ('unfold', convolve)]:
+            def step():
+                outputs[name] = fn(x, attn)
+            times[name] = time_steps(step, args.steps)
+        print("{}\t{:.2f}\t{:.2f}\t{:.2e}".format(
+            attn_len, 1e3 * times['shifted'], 1e3 * times['unfold'],
+            (outputs['unfold'] - outputs['shifted']).abs().max().item()))
+
+def bench_sdpa(args):
+    """Fused scaled-dot-product attention against attention(), on a padded
+    batch. Exits with status 1 if outputs or gradients differ by more than
+    --tolerance."""
+    from multiTransformer import MultiHeadedAttention
+    torch.manual_seed(1)
+    d_model, h = 256, 8
+    mha = {name: MultiHeadedAttention(h, d_model, store_attn=store)
+           for name, store in [('reference', True), ('fused', False)]}
+    mha['fused'].load_state_dict(mha['reference'].state_dict())
+    _, _, mask, lengths = make_batch(args.variant, [], args.batch_size,
+                                     args.seq_len, 1)
+    x = torch.randn(args.batch_size, args.seq_len, d_model)
+    outputs, grads = {}, {}
+    print("mode\tinfer ms\ttrain ms")
+    for name, model in mha.items():
+        model.eval()
+        def infer_step():
+            with torch.no_grad():
+                outputs[name] = model(x, x, x, mask)
+        def train_step():
+            inp = x.clone().requires_grad_()
+            (model(inp, inp, inp, mask) * mask).sum().backward()
+            grads[name] = inp.grad
+            model.zero_grad()
+        infer_time = time_steps(infer_step, args.steps)
+        train_time = time_steps(train_step, args.steps)
+        print("{}\t{:.2f}\t{:.2f}".format(name, 1e3 * infer_time, 1e3 * train_time))
+    out_diff = (outputs['fused'] - outputs['reference']).abs().max().item()
+    grad_diff = (grads['fused'] - grads['reference']).abs().max().item()
+    print("max difference\toutput: {:.2e}\tinput grad: {:.2e}".format(out_diff, grad_diff))
+    if max(out_diff, grad_diff) > args.tolerance:
+        print("FAIL: fused attention does not match attention()")
+        sys.exit(1)
+    print("OK")
+
+def bench_varlen(args):
+    """Transformer encoder on a mixed-length batch, padded vs packed."""
+    from multiTransformer import UniFullTransformer, set_varlen
+    torch.manual_seed(1)
+    window_embed_size = 88
+    model = {name: UniFullTransformer(window_embed_size, device=torch.device('cpu'))
+             for name in ['padded', 'varlen']}
+    model['varlen'].load_state_dict(model['padded'].state_dict())
+    set_varlen(model['varlen'])
+    _, _, mask, lengths = make_batch(args.variant, [], args.batch_size,
+                                     args.seq_len, 1)
+    inputs = torch.randn(args.batch_size, args.seq_len, window_embed_size)
+    outputs = {}
+    print("real timesteps: {} of {}".format(sum(lengths),
+                                            args.batch_size * args.seq_len))
+    print("mode\ttrain steps/s\tinfer steps/s")
+    for name in ['padded', 'varlen']:
+        def train_step():
+            model[name].train()
+            model[name](inputs, mask, lengths).sum().backward()
+            model[name].zero_grad()
+        def infer_step():
+            model[name].eval()
+            with torch.no_grad():
+                outputs[name] = model[name](inputs, mask, lengths)
+        train_time = time_steps(train_step, args.steps)
+        infer_time = time_steps(infer_step, args.steps)
+        print("{}\t{:.1f}\t{:.1f}".format(name, sum(lengths) / train_time,
+                                          sum(lengths) / infer_time))
+    print("max |varlen - padded| prediction: {:.2e}".format(
+        (outputs['varlen'] - outputs['padded']).abs().max().item()))
+
+def bench_window(args):
+    """Full vs sliding-window encoder attention on 5, 15 and 60 minute
+    videos (one rating window per second), single sequence inference."""
+    from multiTransformer import UniFullTransformer
+    import memoryStats
+    torch.manual_seed(1)
+    window_embed_size = 88
+    model = {'full': UniFullTransformer(window_embed_size, device=torch.device('cpu')),
+             'window': UniFullTransformer(window_embed_size, window=args.window,
+                                          n_global=args.n_global,
+                                          device=torch.device('cpu'))}
+    model['window'].load_state_dict(model['full'].state_dict())
+    print("minutes\tmode\tlatency s\tpeak RSS MB")
+    for minutes in [5, 15, 60]:
+        seq_len = 60 * minutes
+        inputs = torch.randn(1, seq_len, window_embed_size)
+        mask = torch.ones(1, seq_len, 1)
+        for name in ['full', 'window']:
+            model[name].eval()
+            def infer_step():
+                with torch.no_grad():
+                    model[name](inputs, mask, [seq_len])
+            memoryStats.reset_peak()
+            latency = time_steps(infer_step, args.steps)
+            print("{}\t{}\t{:.3f}\t{:.1f}".format(minutes, name, latency,
+                                                  memoryStats.peak_rss()))
+
+def bench_branches(args):
+    """Modality branches one after another vs concurrently."""
+    from multiTransformer import set_parallel
+    torch.manual_seed(1)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = build_model(args.variant, args.modalities)
+    data, target, mask, lengths = make_batch(args.variant, model.mods,
+                                             args.batch_size, args.seq_len,
+                                             args.frames)
+    timesteps = sum(lengths)
+    outputs = {}
+    print("intra-op threads: {}".format(torch.get_num_threads()))
+    print("mode\ttrain steps/s\tinfer steps/s")
+    for name, parallel in [('sequential', False), ('parallel', True)]:
+        set_parallel(model, parallel)
+        def train_step():
+            model.train()
+            model(data, lengths, mask).sum().backward()
+            model.zero_grad()
+        def infer_step():
+            model.eval()
+            with torch.no_grad():
+                outputs[name] = model(data, lengths, mask)
+        train_time = time_steps(train_step, args.steps)
+        infer_time = time_steps(infer_step, args.steps)
+        print("{}\t{:.1f}\t{:.1f}".format(name, timesteps / train_time,
+                                          timesteps / infer_time))
+    diff = (outputs['parallel'] - outputs['sequential']).abs().max().item()
+    print("max |parallel - sequential| prediction: {:.2e}".format(diff))
+    if diff > args.tolerance:
+        print("FAIL: concurrent branches change the prediction")
+        sys.exit(1)
+    print("OK")
+
+def bench_decoder(args):
+    """Interpreted vs compiled decoder loops by sequence length."""
+    from multiTransformer import UniTransformer
+    from models import MultiEDLSTM
+    torch.manual_seed(1)
+    device = torch.device('cpu')
+    uni = UniTransformer(88, device=device).eval()
+    edlstm = MultiEDLSTM(88, device=device).eval()
+    def decode_uni(seq_len):
+        encoded = torch.randn(args.batch_size, seq_len, uni.embed_dim)
+        state = uni.init_state(args.batch_size)
+        return lambda: uni.decode(encoded, state)[0]
+    def decode_edlstm(seq_len):
+        context = torch.randn(args.batch_size, seq_len, edlstm.h_dim)
+        p = torch.zeros(args.batch_size, 1)
+        hidden = (edlstm.dec_h0.repeat(1, args.batch_size, 1),
+                  edlstm.dec_c0.repeat(1, args.batch_size, 1))
+        return lambda: edlstm.decode(context, p, hidden)[0]
+    max_diff = 0.0
+    print("model\tseq_len\tloop ms\tfused ms\tmax diff")
+    for name, model, make_decode in [('UniTransformer', uni, decode_uni),
+                                     ('MultiEDLSTM', edlstm, decode_edlstm)]:
+        for seq_len in [args.seq_len // 4, args.seq_len, args.seq_len * 4]:
+            decode = make_decode(seq_len)
+            outputs, times = {}, {}
+            for fused in [False, True]:
+                model.fused = fused
+                def infer_step():
+                    with torch.no_grad():
+                        outputs[fused] = decode()
+                times[fused] = time_steps(infer_step, args.steps)
+            diff = (outputs[True] - outputs[False]).abs().max().item()
+            max_diff = max(max_diff, diff)
+            print("{}\t{}\t{:.2f}\t{:.2f}\t{:.2e}".format(
+                name, seq_len, 1e3 * times[False], 1e3 * times[True], diff))
+    if max_diff > args.tolerance:
+        print("FAIL: compiled decoder does not match the step loop")
+        sys.exit(1)
+    print("OK")
+
+def _checkpoint_worker(layers, args, results):
+    from multiTransformer import MultiTransformer, set_checkpoint
+    import memoryStats
+    torch.manual_seed(1)
+    model = MultiTransformer(args.modalities, window_embed_size,
+                             device=torch.device('cpu'))
+    set_checkpoint(model, layers)
+    model.train()
+    _, _, mask, lengths = make_batch(args.variant, [], args.batch_size,
+                                     args.seq_len, 1)
+    inputs = {mod: torch.randn(args.batch_size, args.seq_len, window_embed_size[mod])
+              for mod in args.modalities}
+    def train_step():
+        # Same dropout masks in every process
+        torch.manual_seed(2)
+        model(inputs, mask, lengths).sum().backward()
+    train_step()
+    grads = torch.cat([param.grad.flatten() for param in model.parameters()
+                       if param.grad is not None])
+    model.zero_grad()
+    memoryStats.reset_peak()
+    rss = memoryStats.summary()['rss']
+    train_step()
+    peak = memoryStats.peak_rss() - rss
+    model.zero_grad()
+    results.put((time_steps(train_step, args.steps), peak, grads))
+
+def bench_checkpoint(args):
+    """MultiTransformer training step with encoder checkpointing off and
+    in segments of 1, 2, 3 and 6 layers, each in a fresh process so the
+    peak RSS growth of a step is measured from a clean heap."""
+    ctx = mp.get_context('spawn')
+    base = None
+    print("layers/segment\tstep s\tpeak growth MB\tmax grad diff")
+    for layers in [0, 1, 2, 3, 6]:
+        results = ctx.SimpleQueue()
+        process = ctx.Process(target=_checkpoint_worker,
+                              args=(layers, args, results))
+        process.start()
+        elapsed, peak, grads = results.get()
+        process.join()
+        if base is None:
+            base = grads
+        diff = (grads - base).abs().max().item()
+        print("{}\t{:.3f}\t{:.1f}\t{:.2e}".format(layers, elapsed, peak, diff))
+        if diff > args.tolerance:
+            print("FAIL: checkpointing changes the gradients")
+            sys.exit(1)
+    print("OK")
+
+def bench_cache(args):
+    """Training steps on raw windows vs cached window embeddings."""
+    import tempfile, shutil
+    import embeddingCache
+    torch.manual_seed(1)
+    model = build_model(args.variant, args.modalities)
+    data, _, lengths = make_sequences(args.variant, model.mods, args.batch_size,
+                                      args.seq_len, args.frames)
+    mask = torch.ones(args.batch_size, args.seq_len, 1)
+    cache_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        cache = embeddingCache.cached_embeddings(model, data, lengths, cache_dir,
+                                                 embeddingCache.cache_key(model),
+                                                 torch.device('cpu'))
+        print("cache build: {:.2f}s".format(time.time() - start))
+        inputs = {'raw': {mod: torch.tensor(data[mod]) for mod in model.mods},
+                  'cached': {mod: torch.from_numpy(np.asarray(cache[mod]))
+                             for mod in model.mods}}
+        outputs = {}
+        print("mode\ttrain steps/s\tinfer steps/s")
+        for name in ['raw', 'cached']:
+            model.cache_windows(name == 'cached')
+            def train_step():
+                model.train()
+                model(inputs[name], lengths, mask).sum().backward()
+                model.zero_grad()
+            def infer_step():
+                model.eval()
+                with torch.no_grad():
+                    outputs[name] = model(inputs[name], lengths, mask)
+            train_time = time_steps(train_step, args.steps)
+            infer_time = time_steps(infer_step, args.steps)
+            print("{}\t{:.1f}\t{:.1f}".format(name, sum(lengths) / train_time,
+                                              sum(lengths) / infer_time))
+    finally:
+        shutil.rmtree(cache_dir)
+    diff = (outputs['cached'] - outputs['raw']).abs().max().item()
+    print("max |cached - raw| prediction: {:.2e}".format(diff))
+    if diff > args.tolerance:
+        print("FAIL: cached embeddings change the prediction")
+        sys.exit(1)
+    print("OK")
+
+def bench_quant(args):
+    """Float32 vs int8 inference latency, model size and CCC.
+
+    With --checkpoints and --data_dir, reports the CCC of every checkpoint
+    (one per modality combination) on each of --subsets, calibrating the
+    static CNN quantization on the first --batch_size Train sequences.
+    """
+    import quantize
+    torch.manual_seed(1)
+    device = torch.device('cpu')
+    model = build_model(args.variant, args.modalities)
+    data, _, mask, lengths = make_batch(args.variant, model.mods,
+                                        args.batch_size, args.seq_len,
+                                        args.frames)
+    def calibrate(m):
+        m(data, lengths, mask)
+    models = [('fp32', model.eval()),
+              ('int8', quantize.quantize(model)),
+              ('int8+conv', quantize.quantize(model, calibrate))]
+    outputs = {}
+    print("mode\tinfer steps/s\tsize MB")
+    for name, m in models:
+        def infer_step():
+            with torch.no_grad():
+                outputs[name] = m(data, lengths, mask)
+        infer_time = time_steps(infer_step, args.steps)
+        print("{}\t{:.1f}\t{:.2f}".format(name, sum(lengths) / infer_time,
+                                          quantize.size_mb(m)))
+    for name, _ in models[1:]:
+        print("max |{} - fp32| prediction: {:.2e}".format(
+            name, (outputs[name] - outputs['fp32']).abs().max().item()))
+    if not args.checkpoints or args.data_dir is None:
+        return
+    import train
+    criterion = nn.MSELoss(reduction='sum')
+    eval_args = argparse.Namespace(device=device, bf16=False)
+    print("modalities\tsubset\tfp32 CCC\tint8 CCC\tint8+conv CCC")
+    for path in args.checkpoints:
+        model, checkpoint = load_model(args.variant, path, device)
+        train_set = load_eval_set(checkpoint, args.data_dir, 'Train')
+        calib_set = ({mod: train_set[0][mod][:args.batch_size]
+                      for mod in model.mods},
+                     train_set[1][:args.batch_size],
+                     train_set[2][:args.batch_size])
+        def calibrate(m):
+            train.evaluate(*calib_set, m, criterion, eval_args)
+        models = [model, quantize.quantize(model),
+                  quantize.quantize(model, calibrate)]
+        for subset in args.subsets:
+            eval_set = load_eval_set(checkpoint, args.data_dir, subset)
+            ccc = []
+            for m in models:
+                with torch.no_grad():
+                    _, _, stats, _ = train.evaluate(*eval_set, m, criterion,
+                                                    eval_args)
+                ccc.append(stats['ccc'])
+            print("{}\t{}\t{:0.5f}\t{:0.5f} ({:+0.5f})\t{:0.5f} ({:+0.5f})".format(
+                ','.join(model.mods), subset, ccc[0], ccc[1], ccc[1] - ccc[0],
+                ccc[2], ccc[2] - ccc[0]))
+
+def bench_export(args):
+    """Exports to TorchScript and ONNX, checks both against the eager model
+    and times a cold start (load plus first prediction) of each."""
+    import tempfile, shutil
+    import export
+    torch.manual_seed(1)
+    reduction = None
+    if args.load is not None:
+        model, checkpoint = load_model(args.variant, args.load)
+        reduction = checkpoint.get('reduction')
+    else:
+        model = build_model(args.variant, args.modalities)
+    out_dir = tempfile.mkdtemp()
+    try:
+        prefix = os.path.join(out_dir, 'model')
+        start = time.time()
+        diffs = export.export(model, prefix, tolerance=args.tolerance,
+                              reduction=reduction)
+        print("export: {:.2f}s".format(time.time() - start))
+        for name, diff in diffs.items():
+            print("max |{} - eager| prediction: {:.2e}".format(name, diff))
+        inputs = export.example_inputs(model, args.batch_size, args.seq_len,
+                                       args.frames)
+        print("format\tcold start s")
+        start = time.time()
+        with torch.no_grad():
+            torch.jit.load(prefix + '.pt')(*inputs)
+        print("torchscript\t{:.3f}".format(time.time() - start))
+        if export.onnx is not None and export.onnxruntime is not None:
+            start = time.time()
+            export.run_onnx(prefix + '.onnx', inputs, model.mods)
+            print("onnx\t{:.3f}".format(time.time() - start))
+    finally:
+        shutil.rmtree(out_dir)
+    print("OK")
+
+def bench_missing(args):
+    """Inference speed with each modality missing in turn, and fused vs
+    loop MFN agreement when one is missing."""
+    from multiTransformer import MFN
+    torch.manual_seed(1)
+    model = build_model(args.variant, args.modalities).eval()
+    data, _, mask, lengths = make_batch(args.variant, model.mods,
+                                        args.batch_size, args.seq_len,
+                                        args.frames)
+    print("missing\tinfer steps/s")
+    for missing in [None] + list(model.mods[1:]):
+        inputs = {mod: x for mod, x in data.items() if mod != missing}
+        def infer_step():
+            with torch.no_grad():
+                model(inputs, lengths, mask)
+        print("{}\t{:.1f}".format(missing, sum(lengths) / time_steps(infer_step, args.steps)))
+    mfns = [m for m in model.modules() if isinstance(m, MFN)]
+    if not mfns:
+        return
+    inputs = {mod: x for mod, x in data.items() if mod != model.mods[-1]}
+    outputs = {}
+    for fused in [True, False]:
+        for mfn in mfns:
+            mfn.fused = fused
+        with torch.no_grad():
+            outputs[fused] = model(inputs, lengths, mask)
+    diff = (outputs[True] - outputs[False]).abs().max().item()
+    print("max |fused - loop| prediction: {:.2e}".format(diff))
+    if diff > args.tolerance:
+        print("FAIL: fused MFN differs without {}".format(model.mods[-1]))
+        sys.exit(1)
+    print("OK")
+
+def bench_reduce(args):
+    """Raw 1000-dim image features vs PCA and random projections to each of
+    --image_dims: padded image input size and training speed on synthetic
+    windows. With --data_dir, also trains --epochs epochs of each setting
+    on Train and reports its best Valid CCC. Needs a featureReduction
+    variant (MFT, SFT, B2-Trans, B3-MFN).
+    """
+    import copy, tempfile, shutil
+    import featureReduction
+    if 'image' not in args.modalities:
+        print("--bench reduce needs the image modality")
+        sys.exit(1)
+    torch.manual_seed(1)
+    settings = [('raw', None, mod_dimension['image'])]
+    for dim in args.image_dims:
+        settings += [('pca', 'pca', dim), ('random', 'random', dim)]
+    data, _, mask, lengths = make_batch(args.variant, args.modalities,
+                                        args.batch_size, args.seq_len,
+                                        args.frames)
+    image = data['image'].numpy().reshape(-1, mod_dimension['image'])
+    print("setting\tdim\tfit s\tvariance kept\timage input MB\ttrain steps/s")
+    for name, method, dim in settings:
+        inputs = dict(data)
+        start = time.time()
+        if method == 'pca':
+            projection = featureReduction.fit_pca([image], dim)
+        elif method == 'random':
+            projection = featureReduction.random_projection(image.shape[1], dim)
+        fit_time = time.time() - start
+        if method is not None:
+            inputs['image'] = torch.from_numpy(projection(image)).view(
+                data['image'].shape[:3] + (dim,))
+        dims = variant_dims(args.variant)
+        dims['image'] = dim
+        model = build_model(args.variant, args.modalities, dims)
+        def train_step():
+            model.train()
+            model(inputs, lengths, mask).sum().backward()
+            model.zero_grad()
+        train_time = time_steps(train_step, args.steps)
+        explained = projection.explained if method == 'pca' else None
+        print("{}\t{}\t{:.2f}\t{}\t{:.1f}\t{:.1f}".format(
+            name, dim, fit_time if method else 0.0,
+            '-' if explained is None else '{:.3f}'.format(explained),
+            inputs['image'].numel() * 4 / 1024.0 ** 2, sum(lengths) / train_time))
+    if args.data_dir is None:
+        return
+    import train
+    from datasets import load_dataset
+    criterion = nn.MSELoss(reduction='sum')
+    train_args = argparse.Namespace(device=torch.device('cpu'), bf16=False,
+                                    log_memory=False, log_freq=1)
+    window_size = {'linguistic' : 5, 'emotient' : 1, 'acoustic' : 1, 'image' : 1, 'ratings' : 1}
+    raw = [load_dataset(args.modalities, args.data_dir, split, truncate=True,
+                        item_as_dict=True) for split in ['Train', 'Valid']]
+    cache_dir = tempfile.mkdtemp()
+    rows = []
+    try:
+        for name, method, dim in settings:
+            splits = []
+            for dataset in raw:
+                # reduce_features replaces the lists, so the raw ones survive
+                dataset = copy.copy(dataset)
+                dataset.data, dataset.orig = dict(dataset.data), dict(dataset.orig)
+                splits.append(dataset)
+            dims = variant_dims(args.variant)
+            start = time.time()
+            if method is not None:
+                projection = featureReduction.load_projection(
+                    method, dim, args.data_dir, cache_dir, train_data=splits[0])
+                featureReduction.reduce_features(projection, 'image', *splits)
+                dims['image'] = dim
+            sets = []
+            for dataset in splits:
+                features, ratings = train.constructInput(
+                    dataset, channels=args.modalities, window_size=window_size)
+                padded, seq_lens = train.padInput(features, args.modalities, dims)
+                sets.append((padded, train.padRating(ratings, max(seq_lens)), seq_lens))
+            load_time = time.time() - start
+            torch.manual_seed(1)
+            model = build_model(args.variant, args.modalities, dims)
+            optimizer = optim.Adam(model.parameters(), lr=1e-4, weight_decay=1e-4)
+            best_ccc, epoch_time = -1, 0.0
+            for epoch in range(1, args.epochs+1):
+                start = time.time()
+                train.train(*sets[0], model, criterion, optimizer, epoch, train_args)
+                epoch_time += time.time() - start
+                with torch.no_grad():
+                    _, _, stats, _ = train.evaluate(*sets[1], model, criterion,
+                                                    train_args)
+                best_ccc = max(best_ccc, stats['ccc'])
+            rows.append((name, dim, load_time, epoch_time / args.epochs, best_ccc))
+    finally:
+        shutil.rmtree(cache_dir)
+    print("setting\tdim\tprojection+windowing s\ts/epoch\tbest Valid CCC")
+    for name, dim, load_time, epoch_time, ccc in rows:
+        print("{}\t{}\t{:.1f}\t{:.1f}\t{:0.5f} ({:+0.5f})".format(
+            name, dim, load_time, epoch_time, ccc, ccc - rows[0][4]))
+
+benches = {
+    'ddp': bench_ddp,
+    'bf16': bench_bf16,
+    'memory': bench_memory,
+    'mfn': bench_mfn,
+    'stream': bench_stream,
+    'arscan': bench_arscan,
+    'convolve': bench_convolve,
+    'sdpa': bench_sdpa,
+    'varlen': bench_varlen,
+    'window': bench_window,
+    'branches': bench_branches,
+    'decoder': bench_decoder,
+    'checkpoint': bench_checkpoint,
+    'cache': bench_cache,
+    'quant': bench_quant,
+    'export': bench_export,
+    'missing': bench_missing,
+    'reduce': bench_reduce,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=str, default='ddp',
+                        choices=sorted(benches.keys()),
+                        help='benchmark to run (default: ddp)')
+    parser.add_argument('--variant', type=str, default='MFT',
+                        help='model directory to import from (default: MFT)')
+    parser.add_argument('--modalities', type=str, nargs='+',
+                        default=['acoustic', 'image', 'linguistic'],
+                        help='input modalities (default: VAL)')
+    parser.add_argument('--batch_size', type=int, default=4, metavar='N',
+                        help='sequences per batch (default: 4)')
+    parser.add_argument('--seq_len', type=int, default=120, metavar='N',
+                        help='rating windows per sequence (default: 120)')
+    parser.add_argument('--frames', type=int, default=30, metavar='N',
+                        help='feature frames per window (default: 30)')
+    parser.add_argument('--steps', type=int, default=5, metavar='N',
+                        help='timed iterations (default: 5)')
+    parser.add_argument('--world_sizes', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='process counts for --bench ddp')
+    parser.add_argument('--master_port', type=int, default=29500, metavar='N',
+                        help='port for the gloo process group (default: 29500)')
+    parser.add_argument('--load', type=str, default=None,
+                        help='checkpoint to benchmark instead of a fresh model')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='data base directory for Valid set metrics')
+    parser.add_argument('--ar_order', type=int, default=1, metavar='N',
+                        help='autoregressive order for --bench arscan (default: 1)')
+    parser.add_argument('--h_dim', type=int, default=512, metavar='N',
+                        help='hidden size for --bench convolve (default: 512)')
+    parser.add_argument('--tolerance', type=float, default=1e-5,
+                        help='max difference allowed by equivalence checks')
+    parser.add_argument('--window', type=int, default=16, metavar='N',
+                        help='attention half-width for --bench window (default: 16)')
+    parser.add_argument('--n_global', type=int, default=0, metavar='N',
+                        help='global timesteps for --bench window (default: 0)')
+    parser.add_argument('--threads', type=int, default=None, metavar='N',
+                        help='intra-op threads for --bench branches (default: all)')
+    parser.add_argument('--mem_batches', type=int, default=4, metavar='N',
+                        help='batches in the short epoch of --bench memory')
+    parser.add_argument('--mem_tolerance', type=float, default=0.5,
+                        help='allowed peak RSS growth as a fraction of the leak --bench memory detects (default: 0.5)')
+    parser.add_argument('--mem_floor', type=float, default=32.0,
+                        help='smallest leak in MB --bench memory can tell from noise (default: 32)')
+    parser.add_argument('--checkpoints', type=str, nargs='+', default=None,
+                        help='checkpoints to evaluate for --bench quant')
+    parser.add_argument('--subsets', type=str, nargs='+', default=['Valid'],
+                        help='data splits for --bench quant (default: Valid)')
+    parser.add_argument('--image_dims', type=int, nargs='+', default=[128, 256],
+                        help='projected image sizes for --bench reduce (default: 128 256)')
+    parser.add_argument('--epochs', type=int, default=10, metavar='N',
+                        help='training epochs per setting for --bench reduce (default: 10)')
+    args = parser.parse_args()
+    add_variant_path(args.variant)
+    benches[args.bench](args)
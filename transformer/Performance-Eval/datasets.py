@@ -12,7 +12,8 @@ class MultiseqDataset(Dataset):
     """Multimodal dataset for (synchronous) time series and sequential data."""
 
     def __init__(self, modalities, dirs, regex, preprocess,
-                 base_rate=None, truncate=False, item_as_dict=False):
+                 base_rate=None, truncate=False, item_as_dict=False,
+                 optional=None):
         """Loads valence ratings and features for each modality.
 
         modalities -- names of each input modality
@@ -23,6 +24,8 @@ class MultiseqDataset(Dataset):
         base_rate -- base_rate to subsample/ovesample to
         truncate -- if true, truncate to modality with minimum length
         item_as_dict -- whether to return data as dictionary
+        optional -- modalities whose files may be missing for some
+                    sequences, whose data is then None
         """
         # Store arguments
         self.modalities = modalities
@@ -61,13 +64,21 @@ class MultiseqDataset(Dataset):
             seq_ids[m].sort()
 
         # Check that number and IDs of files/sequences are matched
-        self.seq_ids = seq_ids[modalities[0]]
-        for m in modalities:
+        if optional is None:
+            optional = []
+        required = [m for m in modalities if m not in optional]
+        self.seq_ids = seq_ids[required[0]]
+        for m in required:
             if len(paths[m]) != len(self.seq_ids):
                 raise Exception("Number of files ({}) do not match.".\
                                 format(len(paths[m])))
             if seq_ids[m] != self.seq_ids:
                 raise Exception("Sequence IDs do not match.")
+        # Optional modalities may lack sequences but not add any
+        for m in optional:
+            if not set(seq_ids[m]) <= set(self.seq_ids):
+                raise Exception("Sequence IDs do not match.")
+        paths = {m: dict(zip(seq_ids[m], paths[m])) for m in modalities}
 
         # # Compute ratio to base rate
         # self.ratios = {m: r/self.base_rate for m, r in
@@ -81,7 +92,12 @@ class MultiseqDataset(Dataset):
             seq_len = float('inf')
             # Load each input modality
             for m, data in self.data.items():
-                fp = paths[m][i]
+                fp = paths[m].get(self.seq_ids[i])
+                if fp is None:
+                    # Missing optional modality
+                    self.orig[m].append(None)
+                    data.append(None)
+                    continue
                 if re.match("^.*\.npy", fp):
                     # Load as numpy array
                     d = np.load(fp)
@@ -94,7 +110,7 @@ class MultiseqDataset(Dataset):
                     d = np.array(preprocess[m](d))
                     seq_len = len(d)
                 elif re.match("^.*\.ssv", fp):
-                    d = pd.read_csv(fp, delim_whitespace=True)
+                    d = pd.read_csv(fp, sep=r'\s+')
                     d = np.array(preprocess[m](d))
                 # Flatten inputs
                 if len(d.shape) > 2:
@@ -129,6 +145,10 @@ class MultiseqDataset(Dataset):
     def __len__(self):
         return len(self.seq_ids)
 
+    def missing(self, i):
+        """Modalities without data for sequence i."""
+        return [m for m in self.modalities if self.data[m][i] is None]
+
     def __getitem__(self, i):
         if self.item_as_dict:
             d = {m: self.data[m][i] for m in self.modalities}
@@ -239,8 +259,13 @@ def seq_collate_dict(data):
     return batch, mask, lengths
 
 def load_dataset(modalities, base_dir, subset,
-                 base_rate=2.0, truncate=False, item_as_dict=False):
-    """Helper function specifically for loading TAC-EA datasets."""
+                 base_rate=2.0, truncate=False, item_as_dict=False,
+                 allow_missing=False):
+    """Helper function specifically for loading TAC-EA datasets.
+
+    With allow_missing, sequences may lack the files of any modality but
+    the ratings; see MultiseqDataset.
+    """
     dirs = {
         'linguistic': os.path.join(base_dir, 'features', subset, 'linguistic-word-level'),
         'linguistic_timer': os.path.join(base_dir, 'features', subset, 'linguistic-word-level'),
@@ -291,10 +316,13 @@ def load_dataset(modalities, base_dir, subset,
     if 'acoustic' in modalities:
         modalities = modalities + ['acoustic_timer']
 
+    optional = None
+    if allow_missing:
+        optional = [m for m in modalities if not m.startswith('ratings')]
     return MultiseqDataset(modalities, [dirs[m] for m in modalities],
                            [regex[m] for m in modalities],
                            [preprocess[m] for m in modalities],
-                           base_rate, truncate, item_as_dict)
+                           base_rate, truncate, item_as_dict, optional)
 
 if __name__ == "__main__":
     # Test code by loading dataset
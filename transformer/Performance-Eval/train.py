@@ -21,6 +21,8 @@ from torch.utils.data import DataLoader
 
 from datasets import seq_collate_dict, load_dataset
 from models import MultiLSTM, MultiEDLSTM, MultiARLSTM, MultiCNNTransformer
+import memoryStats
+from metricsSink import MetricsSink
 
 from random import shuffle
 from operator import itemgetter
@@ -28,14 +30,23 @@ import pprint
 
 import logging
 logFilename = "./train_cnn.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(message)s",
-    handlers=[
-        logging.FileHandler(logFilename, 'w'),
-        logging.StreamHandler()
-    ])
 logger = logging.getLogger()
+# Per-batch and per-epoch scalars, opened by setup_logging()
+metrics = MetricsSink()
+
+def setup_logging(mode='w'):
+    """Logs to logFilename and the console, and metrics next to it (kept
+    out of import time so that spawned worker processes do not truncate
+    the log)."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(message)s",
+        handlers=[
+            logging.FileHandler(logFilename, mode),
+            logging.StreamHandler()
+        ])
+    base = os.path.splitext(logFilename)[0]
+    metrics.open(base + '_metrics.jsonl', base + '_arrays', mode)
 
 def eval_ccc(y_true, y_pred):
     """Computes concordance correlation coefficient."""
@@ -111,11 +122,17 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
     data_num = 0
     loss = 0.0
     batch_num = 0
+    memoryStats.reset_peak()
+    # Print the running loss args.log_freq times per epoch
+    batch_size = 25
+    num_seqs = len(lengths)
+    log_every = max(1, int(np.ceil(num_seqs / batch_size / args.log_freq)))
     # batch our data
     for (data, target, mask, lengths) in generateTrainBatch(input_data,
                                                             input_target,
                                                             lengths,
-                                                            args):
+                                                            args,
+                                                            batch_size=batch_size):
 
         # send to device
         mask = mask.to(args.device)
@@ -125,12 +142,16 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
         # lengths = lengths.to(args.device)
-        # Run forward pass.
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         # Compute loss and gradients
         batch_loss = criterion(output, target)
-        # Accumulate total loss for epoch
-        loss += batch_loss
+        # Accumulate total loss for epoch as a float, so that each batch's
+        # autograd graph is freed once its backward pass is done
+        loss += batch_loss.item()
         # Average over number of non-padding datapoints before stepping
         batch_loss /= sum(lengths)
         batch_loss.backward()
@@ -139,8 +160,10 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
         optimizer.zero_grad()
         # Keep track of total number of time-points
         data_num += sum(lengths)
-        logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
-              format(batch_num, loss/data_num))
+        metrics.log('batch', epoch=epoch, batch=batch_num, loss=loss/data_num)
+        if batch_num % log_every == 0:
+            logger.info('Batch: {:5d}\tLoss: {:2.5f}'.\
+                  format(batch_num, loss/data_num))
         batch_num += 1
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
@@ -148,6 +171,9 @@ def train(input_data, input_target, lengths, model, criterion, optimizer, epoch,
     loss /= data_num
     logger.info('---')
     logger.info('Epoch: {}\tLoss: {:2.5f}'.format(epoch, loss))
+    memory = memoryStats.summary(count_tensors=args.log_memory)
+    logger.info('Memory\t' + memoryStats.format_summary(memory))
+    metrics.log('epoch', epoch=epoch, loss=loss, **memory)
     return loss
 
 def evaluateOnEval(input_data, input_target, lengths, model, criterion, args, fig_path=None):
@@ -169,12 +195,15 @@ def evaluateOnEval(input_data, input_target, lengths, model, criterion, args, fi
         for mod in list(data.keys()):
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
-        # Run forward pass
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         predictions.append(output.reshape(-1).tolist())
         actuals.append(target.reshape(-1).tolist())
         # Compute loss
-        loss += criterion(output, target)
+        loss += criterion(output, target).item()
         # Keep track of total number of time-points
         data_num += sum(lengths)
         # Compute correlation and CCC of predictions against ratings
@@ -218,10 +247,13 @@ def evaluate(input_data, input_target, lengths, model, criterion, args, fig_path
         for mod in list(data.keys()):
             data[mod] = data[mod].to(args.device)
         target = target.to(args.device)
-        # Run forward pass
-        output = model(data, lengths, mask)
+        # Run forward pass (bfloat16 autocast if requested)
+        with torch.autocast(args.device.type, dtype=torch.bfloat16, enabled=args.bf16):
+            output = model(data, lengths, mask)
+        # Loss and metrics are computed in float32
+        output = output.float()
         # Compute loss
-        loss += criterion(output, target)
+        loss += criterion(output, target).item()
         # Keep track of total number of time-points
         data_num += sum(lengths)
         # Compute correlation and CCC of predictions against ratings
@@ -330,8 +362,11 @@ def save_params(args, model, train_stats, test_stats):
     df.set_index('model')
     df.to_csv(fname, mode='a', header=(not os.path.exists(fname)), sep='\t')
 
-def save_checkpoint(modalities, mod_dimension, window_size, model, path):
-    checkpoint = {'modalities': modalities, 'mod_dimension' : mod_dimension, 'window_size' : window_size, 'model': model.state_dict()}
+def save_checkpoint(modalities, mod_dimension, window_size, model, path, state=None):
+    # state -- weight snapshot to save instead of the live model weights
+    if state is None:
+        state = model.state_dict()
+    checkpoint = {'modalities': modalities, 'mod_dimension' : mod_dimension, 'window_size' : window_size, 'model': state}
     torch.save(checkpoint, path)
 
 def load_checkpoint(path, device):
@@ -625,6 +660,10 @@ if __name__ == "__main__":
                         help='print loss N times every epoch (default: 5)')
     parser.add_argument('--eval_freq', type=int, default=1, metavar='N',
                         help='evaluate every N epochs (default: 1)')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='bfloat16 autocast for training and inference (default: false)')
+    parser.add_argument('--log_memory', action='store_true', default=False,
+                        help='also log live tensor counts every epoch (default: false)')
     parser.add_argument('--save_freq', type=int, default=10, metavar='N',
                         help='save every N epochs (default: 10)')
     parser.add_argument('--device', type=str, default='cuda:0',
@@ -646,4 +685,5 @@ if __name__ == "__main__":
     parser.add_argument('--save_dir', type=str, default="./lstm_save",
                         help='path to save models and predictions')
     args = parser.parse_args()
+    setup_logging()
     main(args)
@@ -0,0 +1,95 @@
+"""Asynchronous evaluation of weight snapshots in a separate process."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+def snapshot(model):
+    """Returns a detached CPU copy of the model weights."""
+    return {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+
+def _eval_worker(model_fn, evaluate_fn, eval_set, criterion, args,
+                 snapshots, results):
+    """Evaluates every snapshot received until a None sentinel arrives."""
+    torch.set_num_threads(args.eval_threads)
+    model = model_fn()
+    # evaluate() sends data to args.device, keep it next to the model
+    args.device = model.device
+    while True:
+        item = snapshots.get()
+        if item is None:
+            break
+        epoch, state = item
+        model.load_state_dict(state)
+        with torch.no_grad():
+            _, loss, stats, local_best = \
+                evaluate_fn(*eval_set, model, criterion, args)
+        results.put((epoch, float(loss), stats, local_best))
+
+class AsyncEvaluator(object):
+    """Runs evaluate() on weight snapshots while training continues.
+
+    model_fn -- picklable callable that builds a fresh model on the CPU
+    evaluate_fn -- evaluate(input_data, input_target, lengths,
+                   model, criterion, args) from train.py
+    eval_set -- (input_data, input_target, lengths) of the eval split
+    criterion -- loss function passed on to evaluate_fn
+    args -- parsed command line arguments (needs eval_threads)
+    max_lag -- maximum number of snapshots awaiting results
+    """
+
+    def __init__(self, model_fn, evaluate_fn, eval_set, criterion, args,
+                 max_lag=2):
+        self.max_lag = max_lag
+        # Snapshots submitted but whose results have not been collected
+        self.pending = dict()
+        # spawn keeps the worker clear of the trainer's OpenMP thread pool
+        ctx = mp.get_context('spawn')
+        self.snapshots = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(target=_eval_worker,
+                                   args=(model_fn, evaluate_fn, eval_set,
+                                         criterion, args,
+                                         self.snapshots, self.results),
+                                   daemon=True)
+        self.process.start()
+
+    def submit(self, epoch, model):
+        """Queues a snapshot of the current weights for evaluation."""
+        state = snapshot(model)
+        self.pending[epoch] = state
+        self.snapshots.put((epoch, state))
+
+    def collect(self, wait=False):
+        """Returns finished evaluations in submission order.
+
+        Each entry is (epoch, state, loss, stats, local_best) where state
+        is the evaluated snapshot. Blocks while more than max_lag snapshots
+        are outstanding, or until all of them are done if wait is set.
+        """
+        finished = []
+        while len(self.pending) > 0:
+            block = wait or len(self.pending) > self.max_lag
+            try:
+                epoch, loss, stats, local_best = \
+                    self.results.get(block=block, timeout=5.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("Evaluation worker exited with code {}."
+                                       .format(self.process.exitcode))
+                if block:
+                    continue
+                break
+            state = self.pending.pop(epoch)
+            finished.append((epoch, state, loss, stats, local_best))
+        return finished
+
+    def close(self):
+        """Stops the worker once the queued snapshots are evaluated."""
+        self.snapshots.put(None)
+        self.process.join()
@@ -0,0 +1,88 @@
+"""Disk cache of window embeddings from frozen CNN/Highway encoders."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+
+def _is_window_encoder(name, mods):
+    return name.split('.')[0] in (['cnn_{}'.format(mod) for mod in mods] +
+                                  ['highway_{}'.format(mod) for mod in mods])
+
+def weights_hash(model):
+    """SHA-1 of the window encoder weights of a MultiCNNTransformer."""
+    sha = hashlib.sha1()
+    state = model.state_dict()
+    for name in sorted(state.keys()):
+        if _is_window_encoder(name, model.mods):
+            sha.update(name.encode('utf-8'))
+            sha.update(state[name].detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+def manifest_hash(**manifest):
+    """SHA-1 of a dataset manifest, e.g. the split, sequence ids, window
+    sizes and feature dimensions (values must be JSON serializable)."""
+    text = json.dumps(manifest, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def cache_key(model, **manifest):
+    return '{}-{}'.format(weights_hash(model)[:16], manifest_hash(**manifest)[:16])
+
+def load_window_encoders(model, path, device):
+    """Copies the CNN/Highway weights of a saved checkpoint into model."""
+    state = torch.load(path, map_location=device)['model']
+    state = {k: v for k, v in state.items() if _is_window_encoder(k, model.mods)}
+    model.load_state_dict(state, strict=False)
+
+def _write(model, input_data, lengths, path, device):
+    """Embeds every sequence with model.embed_windows into path/<mod>.npy,
+    zero beyond each sequence's length."""
+    os.makedirs(path)
+    arrays = {}
+    for mod in model.mods:
+        shape = (len(lengths), len(input_data[mod][0]), model.window_embed_size[mod])
+        arrays[mod] = np.lib.format.open_memmap(os.path.join(path, mod + '.npy'),
+                                                mode='w+', dtype=np.float32,
+                                                shape=shape)
+    was_training = model.training
+    model.eval()
+    with torch.no_grad():
+        for i, length in enumerate(lengths):
+            windows = {mod: torch.tensor(input_data[mod][i][:length],
+                                         dtype=torch.float).unsqueeze(0).to(device)
+                       for mod in model.mods}
+            embedded = model.embed_windows(windows)
+            for mod in model.mods:
+                arrays[mod][i, :length] = embedded[mod][0].float().cpu().numpy()
+    model.train(was_training)
+    for mod in model.mods:
+        arrays[mod].flush()
+
+def cached_embeddings(model, input_data, lengths, cache_dir, key, device):
+    """
+    Window embeddings {mod: (num_seqs, max_len, window_embed_size)} of the
+    padded input_data, memory-mapped from cache_dir/key. On a miss they
+    are computed once with the window encoders of model and saved there.
+    The arrays can replace input_data in generateTrainBatch once
+    model.cache_windows() is set.
+    """
+    path = os.path.join(cache_dir, key)
+    if not os.path.isdir(path):
+        # Build under a private name and rename, so concurrent processes
+        # (e.g. data-parallel ranks) never read a partial cache
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        _write(model, input_data, lengths, tmp_path, device)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process finished first
+            shutil.rmtree(tmp_path)
+    return {mod: np.load(os.path.join(path, mod + '.npy'), mmap_mode='r')
+            for mod in model.mods}
@@ -0,0 +1,136 @@
+"""TorchScript and ONNX export of MultiCNNTransformer for serving."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import copy
+import inspect
+
+import torch
+import torch.nn as nn
+
+try:
+    import onnx
+except ImportError:
+    onnx = None
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+from multiTransformer import set_varlen, set_parallel
+
+class Exportable(nn.Module):
+    """
+    MultiCNNTransformer with a flat tensor signature: one
+    (batch_size, windows, frames, dim) tensor per modality in model.mods
+    order, then the (batch_size, windows, 1) mask. Sequence lengths follow
+    from the mask, so the graph takes no Python list.
+    """
+
+    def __init__(self, model):
+        super(Exportable, self).__init__()
+        self.model = model
+
+    def forward(self, *inputs):
+        data = dict(zip(self.model.mods, inputs[:-1]))
+        return self.model(data, None, inputs[-1])
+
+def prepare(model):
+    """Exportable copy of model in eval mode on the CPU, with the settings
+    that tracing cannot follow (variable-length encoders, concurrent
+    branches, cached windows) turned off; model is not changed."""
+    model = copy.deepcopy(model).cpu().eval()
+    for module in model.modules():
+        if hasattr(module, 'device'):
+            module.device = torch.device('cpu')
+    set_varlen(model, False)
+    set_parallel(model, False)
+    model.cache_windows(False)
+    # The wrapper too: torch.onnx.export restores its mode afterwards,
+    # which for a training wrapper puts the whole model in training mode
+    return Exportable(model).eval()
+
+def example_inputs(model, batch_size=2, windows=8, frames=4):
+    """Random inputs for an Exportable, the last sequence half padded."""
+    inputs = [torch.randn(batch_size, windows, frames, model.dims[mod])
+              for mod in model.mods]
+    mask = torch.ones(batch_size, windows, 1)
+    mask[-1, windows // 2:] = 0
+    return tuple(inputs) + (mask,)
+
+def dynamic_axes(mods):
+    axes = {mod: {0: 'batch_size', 1: 'windows', 2: 'frames'} for mod in mods}
+    axes['mask'] = {0: 'batch_size', 1: 'windows'}
+    axes['prediction'] = {0: 'batch_size', 1: 'windows'}
+    return axes
+
+def export_torchscript(exportable, path, inputs):
+    """Traces exportable on inputs and saves the graph to path. The
+    recurrences are compiled functions, so they stay loops over windows."""
+    with torch.no_grad():
+        traced = torch.jit.trace(exportable, inputs, check_trace=False)
+    traced.save(path)
+    return traced
+
+def export_onnx(exportable, path, inputs, opset=17):
+    """Exports exportable to path, with dynamic batch, window and frame
+    axes; inputs are named after the modalities. Uses the TorchScript
+    based exporter, which dynamic_axes is written for; newer torch
+    defaults to the dynamo one, which also needs onnxscript."""
+    mods = exportable.model.mods
+    options = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        options['dynamo'] = False
+    with torch.no_grad():
+        torch.onnx.export(exportable, inputs, path,
+                          input_names=list(mods) + ['mask'],
+                          output_names=['prediction'],
+                          dynamic_axes=dynamic_axes(mods),
+                          opset_version=opset, **options)
+
+def run_onnx(path, inputs, mods):
+    """Prediction of the ONNX graph at path on inputs, with onnxruntime."""
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    feed = {name: x.numpy() for name, x in zip(list(mods) + ['mask'], inputs)}
+    return torch.from_numpy(session.run(None, feed)[0])
+
+def export(model, prefix, opset=17, tolerance=1e-4, reduction=None):
+    """
+    Writes prefix.pt (TorchScript) and prefix.onnx. Both are checked
+    against the eager model on inputs of another batch size, window count
+    and frame count than the export inputs, which exercises the dynamic
+    axes. Given the 'reduction' entry of a --reduce_image checkpoint, the
+    projection is written to prefix.projection.npz too: the graphs take
+    projected image frames, so serving applies it to the raw frames with
+    featureReduction.Projection.load() before windowing, as training did.
+    ONNX export needs onnx and is skipped without it, with a message; the
+    ONNX check also needs onnxruntime.
+    Returns {format: max |exported - eager| prediction}; raises
+    RuntimeError if a difference exceeds tolerance.
+    """
+    exportable = prepare(model)
+    mods = exportable.model.mods
+    if reduction is not None:
+        from featureReduction import entry_projection
+        entry_projection(reduction).save(prefix + '.projection.npz')
+    traced = export_torchscript(exportable, prefix + '.pt',
+                                example_inputs(exportable.model))
+    if onnx is not None:
+        export_onnx(exportable, prefix + '.onnx', example_inputs(exportable.model),
+                    opset)
+    else:
+        print("onnx is not installed, skipping the ONNX export")
+    inputs = example_inputs(exportable.model, batch_size=3, windows=11, frames=6)
+    with torch.no_grad():
+        expected = exportable(*inputs)
+        diffs = {'torchscript': (traced(*inputs) - expected).abs().max().item()}
+    if onnx is not None and onnxruntime is not None:
+        diffs['onnx'] = (run_onnx(prefix + '.onnx', inputs, mods)
+                         - expected).abs().max().item()
+    for name, diff in diffs.items():
+        if diff > tolerance:
+            raise RuntimeError("{} export differs from the eager model by "
+                               "{:.2e}".format(name, diff))
+    return diffs
@@ -0,0 +1,73 @@
+"""Int8 copies of trained models for CPU inference."""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+
+import io
+import copy
+
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+
+# Layers given int8 weights with dynamically quantized activations
+DYNAMIC_LAYERS = {nn.Linear, nn.LSTM, nn.LSTMCell}
+
+def _module_dicts(model):
+    """(dict, key, name) of submodules that models also keep in plain
+    dicts (e.g. MultiTransformer.embed), which module swaps do not reach."""
+    names = {id(m): name for name, m in model.named_modules()}
+    held = []
+    for module in model.modules():
+        for attr, value in vars(module).items():
+            if attr.startswith('_') or not isinstance(value, dict):
+                continue
+            for key, sub in value.items():
+                if isinstance(sub, nn.Module) and id(sub) in names:
+                    held.append((value, key, names[id(sub)]))
+    return held
+
+def _quantize_convs(model, calibrate):
+    """Statically quantizes every Conv1d, with activation ranges observed
+    while calibrate(model) runs float forward passes."""
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for parent in list(model.modules()):
+        for name, child in list(parent.named_children()):
+            if type(child) is nn.Conv1d:
+                wrapped = nn.Sequential(tq.QuantStub(), child, tq.DeQuantStub())
+                wrapped.qconfig = qconfig
+                setattr(parent, name, wrapped)
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        calibrate(model)
+    tq.convert(model, inplace=True)
+
+def quantize(model, calibrate=None):
+    """
+    Returns an int8 copy of a trained model for CPU inference, leaving
+    model as it is. Linear, LSTM and LSTMCell layers (Highway, attention
+    projections, MFN cells, decoders and heads) get int8 weights with
+    dynamically quantized activations. If calibrate is given, the CNN
+    window encoders' Conv1d layers are statically quantized as well;
+    calibrate(model) must run representative forward passes, e.g. over a
+    few training sequences. Compiled paths that read float weights fall
+    back to their interpreted loops on the quantized copy.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for module in model.modules():
+        if hasattr(module, 'device'):
+            module.device = torch.device('cpu')
+    held = _module_dicts(model)
+    if calibrate is not None:
+        _quantize_convs(model, calibrate)
+    tq.quantize_dynamic(model, DYNAMIC_LAYERS, dtype=torch.qint8, inplace=True)
+    for value, key, name in held:
+        value[key] = model.get_submodule(name)
+    return model
+
+def size_mb(model):
+    """Serialized size (MB) of the model's state dict."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024.0 ** 2
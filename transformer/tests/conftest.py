@@ -0,0 +1,59 @@
+"""Shared fixtures: a small synthetic copy of the SENDv1 directory layout."""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+TRANSFORMER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VARIANTS = ['MFT', 'SFT', 'B1-LSTM', 'B2-Trans', 'B3-MFN']
+
+# The in-process tests import the MFT modules; the other variants run as
+# scripts, since every variant has its own train, models and datasets
+sys.path.insert(0, os.path.join(TRANSFORMER_DIR, 'MFT'))
+
+ACOUSTIC_COLUMNS = ([' F0semitoneFrom27.5Hz_sma3nz_amean'] +
+                    [' feature{}'.format(i) for i in range(86)] +
+                    [' equivalentSoundLevel_dBp'])
+
+def write_sequence(base_dir, split, vid, rng, seconds=20.0, latent_dim=4):
+    """Writes every modality of one sequence, all driven by the same latent
+    signal as its ratings, at the rates load_dataset() expects."""
+    t_half = np.arange(0, seconds, 0.5)
+    latent = np.sin(t_half[:, None] * rng.rand(1, latent_dim) + 6 * rng.rand(1, latent_dim))
+    def noisy(dim):
+        return latent.dot(rng.randn(latent_dim, dim)) + 0.1 * rng.randn(len(t_half), dim)
+    features = os.path.join(base_dir, 'features', split)
+    ratings = pd.DataFrame({'time': t_half, 'evaluatorWeightedEstimate': 50 + 40 * latent[:, 0]})
+    ratings.to_csv(os.path.join(base_dir, 'ratings', split, 'observer_EWE',
+                                'results_{}_1.csv'.format(vid)), index=False)
+    name = 'ID{}_vid1_synthetic'.format(vid)
+    image = pd.DataFrame(noisy(1000), columns=['vector{}'.format(k) for k in range(1000)])
+    image.insert(0, 'Frametime', t_half)
+    image.to_csv(os.path.join(features, 'image', name + '.ssv'), sep=' ', index=False)
+    acoustic = pd.DataFrame(noisy(88), columns=ACOUSTIC_COLUMNS)
+    acoustic.insert(0, ' frameTime', t_half)
+    acoustic.to_csv(os.path.join(features, 'acoustic-egemaps', name + '.csv'), index=False)
+    t_word = np.arange(0, seconds, 1.0)
+    for folder, prefix, dim in [('linguistic-word-level', 'glove', 300),
+                                ('linguistic-word-level-bert', 'bert', 1024)]:
+        words = pd.DataFrame(rng.randn(len(t_word), dim),
+                             columns=['{}{}'.format(prefix, k) for k in range(dim)])
+        words.insert(0, 'time-offset', t_word)
+        words.to_csv(os.path.join(features, folder, name + '.tsv'), sep='\t', index=False)
+
+@pytest.fixture(scope='session')
+def send_data(tmp_path_factory):
+    """Data directory with four Train and two Valid sequences."""
+    base_dir = str(tmp_path_factory.mktemp('SENDv1-data'))
+    rng = np.random.RandomState(0)
+    for split, vids in [('Train', range(1, 5)), ('Valid', range(5, 7))]:
+        for folder in ['image', 'acoustic-egemaps', 'linguistic-word-level',
+                       'linguistic-word-level-bert']:
+            os.makedirs(os.path.join(base_dir, 'features', split, folder))
+        os.makedirs(os.path.join(base_dir, 'ratings', split, 'observer_EWE'))
+        for vid in vids:
+            write_sequence(base_dir, split, vid, rng)
+    return base_dir
@@ -0,0 +1,33 @@
+"""End-to-end data-parallel training: train.py --world_size 2 of every variant."""
+
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from conftest import TRANSFORMER_DIR, VARIANTS
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.mark.parametrize('variant', VARIANTS)
+def test_two_ranks_train_and_save(variant, send_data, tmp_path):
+    # train.py saves to ../ModelSave/<variant> and logs to the working directory
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    save_dir = tmp_path / 'ModelSave' / variant
+    save_dir.mkdir(parents=True)
+    # The spawned ranks never run train.py's __main__ block, so this
+    # catches anything that still reads its globals
+    result = subprocess.run(
+        [sys.executable, os.path.join(TRANSFORMER_DIR, variant, 'train.py'),
+         '--world_size', '2', '--master_port', str(free_port()), '--epochs', '1',
+         '--data_dir', send_data],
+        cwd=str(run_dir), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, timeout=900)
+    assert result.returncode == 0, result.stdout[-4000:]
+    assert any(name.endswith('.pth') for name in os.listdir(str(save_dir)))
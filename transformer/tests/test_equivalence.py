@@ -0,0 +1,178 @@
+"""The optimized paths against the reference code they replace, on the
+MFT copy of the shared modules (see benchmark.py for their timings)."""
+
+import pytest
+import torch
+
+from multiTransformer import (MFN, MultiHeadedAttention, MultiTransformer, UniFullTransformer,
+                              UniTransformer, attention, fused_attention, local_attention,
+                              set_checkpoint, set_parallel, set_varlen)
+from models import MultiARLSTM, MultiEDLSTM, convolve, pad_shift
+
+CPU = torch.device('cpu')
+MFN_DIMS = {'linguistic': 32, 'acoustic': 32, 'image': 32}
+ENCODER_DIMS = {'linguistic': 300, 'emotient': 20, 'acoustic': 88, 'image': 256}
+
+def padded_batch(lengths, seq_len):
+    """batch x seq_len x 1 mask of sequences of the given lengths."""
+    mask = torch.zeros(len(lengths), seq_len, 1)
+    for i, l in enumerate(lengths):
+        mask[i, :l] = 1
+    return mask
+
+def assert_close(actual, expected, tolerance=1e-5):
+    assert (actual - expected).abs().max().item() <= tolerance
+
+def twin(make):
+    """Two modules built by make() with the same weights."""
+    torch.manual_seed(1)
+    first, second = make(), make()
+    second.load_state_dict(first.state_dict())
+    return first, second
+
+@pytest.mark.parametrize('block_diag', [False, True])
+@pytest.mark.parametrize('training', [False, True])
+def test_fused_mfn_matches_loop(block_diag, training):
+    loop, fused = twin(lambda: MFN(list(MFN_DIMS), MFN_DIMS, 1, device=CPU))
+    loop.fused = False
+    fused.block_diag = block_diag
+    inputs = {mod: torch.randn(12, 3, MFN_DIMS[mod], requires_grad=True) for mod in MFN_DIMS}
+    outputs, grads = [], []
+    for model in [loop, fused]:
+        model.train(training)
+        # The same dropout noise on both paths
+        torch.manual_seed(2)
+        output = model(inputs)
+        outputs.append(output)
+        grads.append(torch.autograd.grad(output.sum(), list(inputs.values()) + list(model.parameters())))
+    assert_close(outputs[1], outputs[0])
+    for fused_grad, loop_grad in zip(grads[1], grads[0]):
+        assert_close(fused_grad, loop_grad)
+
+def test_fused_mfn_matches_loop_with_missing_modality():
+    loop, fused = twin(lambda: MFN(list(MFN_DIMS), MFN_DIMS, 1, device=CPU))
+    loop.fused = False
+    inputs = {'linguistic': torch.randn(12, 3, 32), 'image': torch.randn(12, 3, 32)}
+    with torch.no_grad():
+        assert_close(fused.eval()(inputs), loop.eval()(inputs))
+
+def test_mfn_step_matches_forward():
+    torch.manual_seed(1)
+    model = MFN(list(MFN_DIMS), MFN_DIMS, 1, device=CPU).eval()
+    inputs = {mod: torch.randn(12, 3, MFN_DIMS[mod]) for mod in MFN_DIMS}
+    with torch.no_grad():
+        full = model(inputs)
+        state = model.init_state(3)
+        streamed = []
+        for t in range(12):
+            prediction, state = model.step({mod: inputs[mod][t] for mod in MFN_DIMS}, state)
+            streamed.append(prediction)
+    assert_close(torch.stack(streamed, dim=1), full)
+
+def test_fused_attention_matches_stored_attention():
+    reference, fused = twin(lambda: MultiHeadedAttention(4, 32, store_attn=True))
+    fused.store_attn = False
+    mask = padded_batch([10, 6, 1], 10).transpose(-2, -1)
+    x = torch.randn(3, 10, 32)
+    outputs, grads = [], []
+    for model in [reference, fused]:
+        model.eval()
+        inputs = x.clone().requires_grad_()
+        output = model(inputs, inputs, inputs, mask)
+        (output * mask.transpose(-2, -1)).sum().backward()
+        outputs.append(output)
+        grads.append(inputs.grad)
+    assert_close(outputs[1], outputs[0])
+    assert_close(grads[1], grads[0])
+
+def test_fused_attention_with_every_key_masked():
+    query, key, value = torch.randn(3, 2, 4, 5, 8).unbind(0)
+    mask = torch.ones(2, 1, 1, 5)
+    mask[1] = 0
+    expected, _ = attention(query, key, value, mask=mask)
+    assert_close(fused_attention(query, key, value, mask=mask), expected)
+
+@pytest.mark.parametrize('n_global', [0, 2])
+def test_wide_local_attention_matches_attention(n_global):
+    # A window spanning the whole sequence leaves every key in reach
+    query, key, value = torch.randn(3, 2, 4, 9, 8).unbind(0)
+    mask = padded_batch([9, 5], 9).view(2, 1, 1, 9)
+    expected, _ = attention(query, key, value, mask=mask)
+    actual = local_attention(query, key, value, window=8, n_global=n_global, mask=mask)
+    # Queries at padded steps differ (masked keys are dropped, not scored)
+    real = mask.view(2, 1, 9, 1) != 0
+    assert_close(actual * real, expected * real)
+
+def test_varlen_encoder_matches_padded():
+    padded, varlen = twin(lambda: UniFullTransformer(88, N=2, device=CPU))
+    set_varlen(varlen)
+    lengths = [10, 7, 3]
+    mask = padded_batch(lengths, 10)
+    inputs = torch.randn(3, 10, 88)
+    with torch.no_grad():
+        assert_close(varlen.eval()(inputs, mask, lengths), padded.eval()(inputs, mask, lengths))
+
+def test_checkpointed_gradients_match():
+    stored, checkpointed = twin(lambda: MultiTransformer(['acoustic', 'image'], ENCODER_DIMS,
+                                                         N=4, device=CPU))
+    set_checkpoint(checkpointed, 2)
+    lengths = [10, 7, 3]
+    mask = padded_batch(lengths, 10)
+    inputs = {mod: torch.randn(3, 10, ENCODER_DIMS[mod]) for mod in ['acoustic', 'image']}
+    grads = []
+    for model in [stored, checkpointed]:
+        model.train()
+        # Recomputed segments replay the dropout noise of the first pass
+        torch.manual_seed(2)
+        model(inputs, mask, lengths).sum().backward()
+        grads.append([param.grad for param in model.parameters()])
+    for checkpointed_grad, stored_grad in zip(grads[1], grads[0]):
+        # Parameters of the unused modalities get no gradient on either path
+        assert (checkpointed_grad is None) == (stored_grad is None)
+        if stored_grad is not None:
+            assert_close(checkpointed_grad, stored_grad)
+
+def test_parallel_branches_match_sequential():
+    torch.manual_seed(1)
+    model = MultiTransformer(['linguistic', 'acoustic', 'image'], ENCODER_DIMS, N=2,
+                             device=CPU).eval()
+    mask = padded_batch([10, 7, 3], 10)
+    inputs = {mod: torch.randn(3, 10, ENCODER_DIMS[mod])
+              for mod in ['linguistic', 'acoustic', 'image']}
+    with torch.no_grad():
+        sequential = model(inputs, mask, None)
+        set_parallel(model)
+        parallel = model(inputs, mask, None)
+    assert_close(parallel, sequential)
+
+def test_compiled_decoders_match_step_loops():
+    torch.manual_seed(1)
+    uni = UniTransformer(88, N=1, device=CPU).eval()
+    edlstm = MultiEDLSTM(88, device=CPU).eval()
+    encoded = torch.randn(3, 10, uni.embed_dim)
+    context = torch.randn(3, 10, edlstm.h_dim)
+    hidden = (edlstm.dec_h0.repeat(1, 3, 1), edlstm.dec_c0.repeat(1, 3, 1))
+    outputs = {}
+    with torch.no_grad():
+        for fused in [False, True]:
+            uni.fused = edlstm.fused = fused
+            outputs[fused] = (uni.decode(encoded, uni.init_state(3))[0],
+                              edlstm.decode(context, torch.zeros(3, 1), hidden)[0])
+    for compiled, loop in zip(outputs[True], outputs[False]):
+        assert_close(compiled, loop)
+
+@pytest.mark.parametrize('ar_order', [1, 3])
+def test_ar_scan_matches_loop(ar_order):
+    loop, scan = twin(lambda: MultiARLSTM(88, ar_order=ar_order, scan=True, device=CPU))
+    loop.scan = False
+    lengths = [10, 10, 10]
+    mask = padded_batch(lengths, 10)
+    inputs = torch.randn(3, 10, 88)
+    with torch.no_grad():
+        assert_close(scan.eval()(inputs, mask, lengths), loop.eval()(inputs, mask, lengths))
+
+def test_convolve_matches_shifted_copies():
+    x = torch.randn(3, 10, 16)
+    attn = torch.softmax(torch.randn(3, 10, 5), dim=-1)
+    stacked = torch.stack([pad_shift(x, i) for i in range(5)], dim=-1)
+    assert_close(convolve(x, attn), torch.sum(attn.unsqueeze(2) * stacked, dim=-1))
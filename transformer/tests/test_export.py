@@ -0,0 +1,43 @@
+"""TorchScript and ONNX export of multi-modality MFT models."""
+
+import os
+
+import pytest
+import torch
+
+import export
+from models import MultiCNNTransformer
+
+MOD_DIMENSION = {'linguistic': 300, 'emotient': 20, 'acoustic': 88, 'image': 1000}
+WINDOW_EMBED_SIZE = {'linguistic': 300, 'emotient': 20, 'acoustic': 88, 'image': 256}
+
+def build_model(mods):
+    torch.manual_seed(1)
+    return MultiCNNTransformer(mods=mods, dims=MOD_DIMENSION, embed_dims=WINDOW_EMBED_SIZE,
+                               device=torch.device('cpu'))
+
+@pytest.mark.parametrize('mods', [['acoustic', 'image'],
+                                  ['linguistic', 'acoustic', 'image']])
+def test_export_matches_eager(mods, tmp_path):
+    model = build_model(mods)
+    prefix = str(tmp_path / 'model')
+    diffs = export.export(model, prefix, tolerance=1e-5)
+    assert diffs['torchscript'] <= 1e-5
+    if export.onnx is not None and export.onnxruntime is not None:
+        assert diffs['onnx'] <= 1e-5
+    # The saved graph, on yet another input shape
+    inputs = export.example_inputs(model, batch_size=1, windows=5, frames=3)
+    with torch.no_grad():
+        expected = export.prepare(model)(*inputs)
+        loaded = torch.jit.load(prefix + '.pt')(*inputs)
+    assert (loaded - expected).abs().max().item() <= 1e-5
+    # export() works on a copy
+    assert model.training
+
+def test_export_without_onnx(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'onnx', None)
+    prefix = str(tmp_path / 'model')
+    diffs = export.export(build_model(['acoustic', 'image']), prefix, tolerance=1e-5)
+    assert list(diffs) == ['torchscript']
+    assert os.path.exists(prefix + '.pt')
+    assert not os.path.exists(prefix + '.onnx')